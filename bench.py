@@ -0,0 +1,375 @@
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+from datetime import datetime, timedelta
+
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark")
+import discord
+import bot
+
+
+class FakeObject:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeUser:
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.bot = False
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def mention(self):
+        return f"<@{self.id}>"
+
+
+class FakeAttachment:
+    def __init__(self, attachment_id, filename, size, latency):
+        self.id = attachment_id
+        self.filename = filename
+        self.size = size
+        self.url = f"https://cdn.discordapp.com/attachments/{attachment_id}/{filename}"
+        self.content_type = None
+        self.latency = latency
+
+    async def save(self, fp, **kwargs):
+        await asyncio.sleep(self.latency)
+        with open(fp, "wb") as f:
+            f.write(random.Random(self.id).randbytes(self.size))
+        return self.size
+
+
+class FakeMessage:
+    def __init__(self, message_id, channel, author, content, created_at, embeds, attachments, mentions):
+        self.id = message_id
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.clean_content = content
+        self.created_at = created_at
+        self.embeds = embeds
+        self.attachments = attachments
+        self.mentions = mentions
+        self.role_mentions = []
+        self.raw_mentions = [user.id for user in mentions]
+        self.raw_role_mentions = []
+        self.raw_channel_mentions = []
+
+
+class FakeTextChannel:
+    page_size = 100
+
+    def __init__(self, guild, channel_id, name, position, category=None, latency=0.0):
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.position = position
+        self.category = category
+        self.topic = None
+        self.slowmode_delay = 0
+        self.overwrites = {}
+        self.messages = []
+        self.latency = latency
+        self.sent = 0
+        self.history_calls = 0
+
+    def is_nsfw(self):
+        return False
+
+    async def history(self, limit=None, oldest_first=None, after=None, before=None):
+        messages = self.messages
+        if after is not None:
+            messages = [msg for msg in messages if msg.id > after.id]
+        if limit is not None:
+            messages = messages[:limit]
+        for index, msg in enumerate(messages):
+            if index % self.page_size == 0:
+                self.history_calls += 1
+                await asyncio.sleep(self.latency)
+            yield msg
+
+    async def send(self, content=None, embeds=None, files=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        for file in files or ():
+            file.close()
+        self.sent += 1
+        return FakeObject(id=self.sent)
+
+    async def delete(self, reason=None):
+        if self in self.guild.channels:
+            self.guild.channels.remove(self)
+        if self in self.guild.text_channels:
+            self.guild.text_channels.remove(self)
+
+
+class FakeCategory:
+    def __init__(self, guild, category_id, name, position):
+        self.guild = guild
+        self.id = category_id
+        self.name = name
+        self.position = position
+        self.overwrites = {}
+
+    async def delete(self, reason=None):
+        if self in self.guild.channels:
+            self.guild.channels.remove(self)
+        if self in self.guild.categories:
+            self.guild.categories.remove(self)
+
+
+class FakeRole:
+    def __init__(self, role_id, name, position, default=False):
+        self.id = role_id
+        self.name = name
+        self.position = position
+        self.permissions = discord.Permissions(0)
+        self.color = discord.Colour(0)
+        self.hoist = False
+        self.mentionable = False
+        self.managed = False
+        self.default = default
+
+    def is_default(self):
+        return self.default
+
+    async def delete(self, reason=None):
+        pass
+
+
+class FakeProgressMessage:
+    def __init__(self):
+        self.edits = 0
+
+    async def edit(self, **kwargs):
+        self.edits += 1
+
+
+class FakeGuild:
+    def __init__(self, channels=10, messages=1000, embed_density=0.1, attachment_density=0.0, attachment_size=4096, latency=0.0, seed=1):
+        rnd = random.Random(seed)
+        self.ids = iter(range(10 ** 12, 10 ** 13))
+        self.id = 424242
+        self.name = "Benchmark Guild"
+        self.owner_id = 1
+        self.member_count = 50
+        self.created_at = datetime(2020, 1, 1)
+        self.latency = latency
+        self.default_role = FakeRole(self.id, "@everyone", 0, default=True)
+        self.roles = [self.default_role] + [FakeRole(next(self.ids), f"role-{i}", i + 1) for i in range(5)]
+        self.categories = [FakeCategory(self, next(self.ids), f"category-{i}", i) for i in range(max(1, channels // 10))]
+        self.emojis = []
+        self.users = [FakeUser(next(self.ids), f"user{i}") for i in range(50)]
+        self.text_channels = []
+        message_id = 10 ** 15
+        for index in range(channels):
+            channel = FakeTextChannel(
+                self,
+                next(self.ids),
+                f"channel-{index}",
+                index,
+                self.categories[index % len(self.categories)],
+                latency,
+            )
+            created_at = datetime(2021, 1, 1)
+            for number in range(messages):
+                message_id += 1
+                author = self.users[rnd.randrange(len(self.users))]
+                embeds = []
+                if rnd.random() < embed_density:
+                    embeds.append(discord.Embed(title=f"Log {number % 7}", description="Automated log entry", colour=0x5865F2))
+                attachments = []
+                if rnd.random() < attachment_density:
+                    attachments.append(FakeAttachment(message_id, f"file{number % 13}.bin", attachment_size, latency))
+                mentioned = self.users[rnd.randrange(len(self.users))]
+                content = f"message {number} for {mentioned.mention} " + "lorem ipsum " * rnd.randint(1, 20)
+                channel.messages.append(
+                    FakeMessage(
+                        message_id,
+                        channel,
+                        author,
+                        content,
+                        created_at + timedelta(seconds=number),
+                        embeds,
+                        attachments,
+                        [mentioned],
+                    )
+                )
+            self.text_channels.append(channel)
+        self.channels = list(self.text_channels) + list(self.categories)
+        self.me = FakeObject(guild_permissions=FakeObject(administrator=True))
+
+    @classmethod
+    def empty(cls, guild_id, latency=0.0):
+        guild = cls(channels=0, messages=0, latency=latency)
+        guild.id = guild_id
+        guild.roles = [guild.default_role]
+        guild.categories = []
+        guild.channels = []
+        return guild
+
+    def get_channel(self, channel_id):
+        return next((channel for channel in self.channels if channel.id == channel_id), None)
+
+    def get_role(self, role_id):
+        return next((role for role in self.roles if role.id == role_id), None)
+
+    async def create_role(self, name=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        role = FakeRole(next(self.ids), name, len(self.roles))
+        self.roles.append(role)
+        return role
+
+    async def edit_role_positions(self, positions, **kwargs):
+        await asyncio.sleep(self.latency)
+        for role, position in positions.items():
+            role.position = position
+
+    async def create_category(self, name=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        category = FakeCategory(self, next(self.ids), name, kwargs.get("position", 0))
+        self.categories.append(category)
+        self.channels.append(category)
+        return category
+
+    async def create_text_channel(self, name=None, category=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        channel = FakeTextChannel(self, next(self.ids), name, kwargs.get("position", 0), category, self.latency)
+        self.text_channels.append(channel)
+        self.channels.append(channel)
+        return channel
+
+
+BACKENDS = {
+    "txt": bot.backup_messages_txt,
+    "json": bot.backup_messages_json,
+    "db": bot.backup_messages_db,
+}
+
+
+def directory_size(path):
+    return sum(p.stat().st_size for p in Path(path).rglob("*") if p.is_file())
+
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+
+async def measure(coro_factory):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = await coro_factory()
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+async def bench_backend(args, method, work_dir):
+    guild = FakeGuild(
+        channels=args.channels,
+        messages=args.messages,
+        embed_density=args.embeds,
+        attachment_density=args.attachments,
+        latency=args.latency,
+        seed=args.seed,
+    )
+    backup_dir = work_dir / f"backup_{method}"
+    backup_dir.mkdir()
+    bot.MEDIA_STORE_DIR = work_dir / f"media_store_{method}"
+    total_messages = args.channels * args.messages
+    data_path, elapsed, peak = await measure(
+        lambda: BACKENDS[method](guild, backup_dir, args.mode, FakeProgressMessage())
+    )
+    structure_path = await bot.backup_guild_structure(guild, backup_dir)
+    row = {
+        "backend": method,
+        "messages": total_messages,
+        "backup_seconds": round(elapsed, 3),
+        "backup_msgs_per_second": round(total_messages / elapsed, 1) if elapsed else 0.0,
+        "backup_peak_memory": peak,
+        "output_size": directory_size(backup_dir),
+        "history_calls": sum(channel.history_calls for channel in guild.text_channels),
+    }
+    if args.restore and method in ("json", "db"):
+        meta = {"data_files": {method: Path(data_path).relative_to(backup_dir).as_posix()}}
+        structure = bot.read_json_file(structure_path)
+        target = FakeGuild.empty(guild.id, latency=args.latency)
+
+        async def restore():
+            channel_messages = await bot.load_channel_messages([(backup_dir, meta)])
+            return await bot.restore_guild(target, structure, channel_messages, FakeProgressMessage(), args.compact)
+
+        _, elapsed, peak = await measure(restore)
+        row.update(
+            {
+                "restore_seconds": round(elapsed, 3),
+                "restore_msgs_per_second": round(total_messages / elapsed, 1) if elapsed else 0.0,
+                "restore_peak_memory": peak,
+                "restore_sends": sum(channel.sent for channel in target.text_channels),
+            }
+        )
+    return row
+
+
+def print_report(rows):
+    print(f"{'backend':<8} {'messages':>9} {'backup s':>9} {'msg/s':>10} {'peak mem':>10} {'output':>10} {'restore s':>10} {'msg/s':>10} {'sends':>7}")
+    for row in rows:
+        print(
+            f"{row['backend']:<8} {row['messages']:>9} {row['backup_seconds']:>9} {row['backup_msgs_per_second']:>10} "
+            f"{format_bytes(row['backup_peak_memory']):>10} {format_bytes(row['output_size']):>10} "
+            f"{row.get('restore_seconds', '-'):>10} {row.get('restore_msgs_per_second', '-'):>10} {row.get('restore_sends', '-'):>7}"
+        )
+
+
+async def main(args):
+    methods = [method.strip() for method in args.backends.split(",") if method.strip()]
+    for method in methods:
+        if method not in BACKENDS:
+            raise SystemExit(f"Backend sconosciuto: {method}")
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="backup_bench_") as tmp:
+        work_dir = Path(args.keep or tmp)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        for method in methods:
+            rows.append(await bench_backend(args, method, work_dir))
+    print_report(rows)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"parameters": vars(args), "results": rows}, f, indent=2)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline dei backend di backup e ripristino con un server finto.")
+    parser.add_argument("--channels", type=int, default=10, help="canali di testo del server finto")
+    parser.add_argument("--messages", type=int, default=2000, help="messaggi per canale")
+    parser.add_argument("--embeds", type=float, default=0.1, help="frazione di messaggi con un embed")
+    parser.add_argument("--attachments", type=float, default=0.0, help="frazione di messaggi con un allegato (solo modalità full)")
+    parser.add_argument("--latency", type=float, default=0.0, help="latenza simulata in secondi per ogni chiamata API")
+    parser.add_argument("--mode", choices=("rapido", "full"), default="full", help="modalità di backup")
+    parser.add_argument("--backends", default="txt,json,db", help="backend da misurare, separati da virgola")
+    parser.add_argument("--restore", action="store_true", help="misura anche il ripristino dei backend json e db")
+    parser.add_argument("--compact", action="store_true", help="usa il ripristino compatto")
+    parser.add_argument("--seed", type=int, default=1, help="seme del generatore casuale")
+    parser.add_argument("--keep", help="cartella in cui lasciare i backup generati")
+    parser.add_argument("--json", help="scrive i risultati anche in questo file JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
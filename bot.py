@@ -1,7 +1,21 @@
 import os
 import json
+import re
+import random
+import shutil
 import asyncio
+import codecs
+import logging
+import contextlib
+import hashlib
+import collections
+import itertools
+import concurrent.futures
 import sqlite3
+import struct
+import tempfile
+import time
+import zlib
 from pathlib import Path
 from datetime import datetime
 import discord
@@ -26,8 +40,69 @@ def load_env_from_file(path=".env"):
                 os.environ[key] = value
 
 
+def env_int(name, default):
+    try:
+        return int(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+load_env_from_file()
+BACKUP_CONCURRENCY = max(1, env_int("BACKUP_CONCURRENCY", 4))
+BACKUP_DB_BATCH_SIZE = max(1, env_int("BACKUP_DB_BATCH_SIZE", 5000))
+RESTORE_CONCURRENCY = max(1, env_int("RESTORE_CONCURRENCY", 4))
+BACKUP_CHECKPOINT_INTERVAL = max(1, env_int("BACKUP_CHECKPOINT_INTERVAL", 1000))
+MEDIA_STORE_DIR = Path(os.getenv("BACKUP_MEDIA_STORE", "media_store"))
+BACKUP_DOWNLOAD_CONCURRENCY = max(1, env_int("BACKUP_DOWNLOAD_CONCURRENCY", 4))
+BACKUP_DOWNLOAD_QUEUE = max(1, env_int("BACKUP_DOWNLOAD_QUEUE", 100))
+BACKUP_DOWNLOAD_RETRIES = max(0, env_int("BACKUP_DOWNLOAD_RETRIES", 3))
+BACKUP_MAX_MEDIA_BYTES = max(0, env_int("BACKUP_MAX_MEDIA_BYTES", 0))
+BACKUP_MEDIA_BANDWIDTH = max(0, env_int("BACKUP_MEDIA_BANDWIDTH", 0))
+BACKUP_PENDING_MESSAGES = max(1, env_int("BACKUP_PENDING_MESSAGES", 500))
+BACKUP_WRITE_QUEUE = max(1, env_int("BACKUP_WRITE_QUEUE", 64))
+BACKUP_WRITE_BATCH = max(1, env_int("BACKUP_WRITE_BATCH", 200))
+BACKUP_CLEAN_CONTENT = env_int("BACKUP_CLEAN_CONTENT", 0) != 0
+BACKUP_LEAN_MODE = env_int("BACKUP_LEAN_MODE", 1) != 0
+BACKUP_VERIFY_WORKERS = max(1, env_int("BACKUP_VERIFY_WORKERS", os.cpu_count() or 4))
+BACKUP_JOBS_DB = os.getenv("BACKUP_JOBS_DB", "backup_jobs.db")
+BACKUP_MAX_JOBS = max(1, env_int("BACKUP_MAX_JOBS", 2))
+BACKUP_MAX_JOBS_PER_GUILD = max(1, env_int("BACKUP_MAX_JOBS_PER_GUILD", 1))
+BACKUP_GLOBAL_CONCURRENCY = max(1, env_int("BACKUP_GLOBAL_CONCURRENCY", 8))
+BACKUP_METRICS_HOST = os.getenv("BACKUP_METRICS_HOST", "127.0.0.1")
+BACKUP_METRICS_PORT = max(0, env_int("BACKUP_METRICS_PORT", 0))
+BACKUP_ARCHIVE_BLOCK_SIZE = max(1 << 12, env_int("BACKUP_ARCHIVE_BLOCK_SIZE", 1 << 20))
+BACKUP_ARCHIVE_LEVEL = min(9, max(1, env_int("BACKUP_ARCHIVE_LEVEL", 6)))
+DB_SCHEMA_VERSION = 5
+SEARCH_INDEX_FILE = "search.db"
+MEMBER_LIST_FILE = "member_list.txt"
+SEARCH_RESULTS = 10
+VIEWER_BUNDLE = env_int("BACKUP_VIEWER_BUNDLE", 1) != 0
+VIEWER_BUNDLE_DIR = "viewer"
+VIEWER_PAGE_SIZE = max(1, env_int("BACKUP_VIEWER_PAGE_SIZE", 500))
+ARCHIVE_FILE = "backup_archive.gz"
+DISCORD_MESSAGE_LIMIT = 2000
+DISCORD_MAX_EMBEDS = 10
+DISCORD_MAX_EMBED_CHARS = 6000
+DISCORD_MAX_FILES = 10
+
 intents = discord.Intents.all()
-bot = commands.Bot(command_prefix='!', intents=intents)
+bot_options = {}
+if BACKUP_LEAN_MODE:
+    intents.presences = False
+    bot_options = {
+        "chunk_guilds_at_startup": False,
+        "member_cache_flags": discord.MemberCacheFlags.none(),
+        "max_messages": None,
+    }
+
+
+class BackupBot(commands.Bot):
+    async def close(self):
+        await job_queue.stop()
+        await super().close()
+
+
+bot = BackupBot(command_prefix='!', intents=intents, **bot_options)
 
 
 def generate_progress_bar(current, total, length=20):
@@ -45,17 +120,791 @@ def sanitize_name(name):
     return "".join(c for c in name if c.isalnum() or c in (" ", "-", "_")).strip() or "unknown"
 
 
+def unique_channel_names(channels):
+    names = {}
+    used = set()
+    for channel in channels:
+        safe_name = sanitize_name(channel.name) or str(channel.id)
+        if safe_name.lower() in used:
+            safe_name = f"{safe_name}_{channel.id}"
+        used.add(safe_name.lower())
+        names[channel.id] = safe_name
+    return names
+
+
+channel_slots = None
+
+
+def global_channel_slots():
+    global channel_slots
+    if channel_slots is None:
+        channel_slots = asyncio.Semaphore(BACKUP_GLOBAL_CONCURRENCY)
+    return channel_slots
+
+
+async def run_channel_pool(channels, worker, progress_msg, label, concurrency=None, status=None):
+    total_channels = len(channels)
+    completed_channels = 0
+    results = [None] * total_channels
+    queue = asyncio.Queue()
+    for index, channel in enumerate(channels):
+        queue.put_nowait((index, channel))
+
+    async def progress_updater():
+        while completed_channels < total_channels:
+            bar = generate_progress_bar(completed_channels, total_channels)
+            content = f"📨 Backup messaggi {label}: {bar}"
+            if status:
+                content += f"\n{status()}"
+            await progress_msg.edit(content=content)
+            await asyncio.sleep(2)
+
+    async def channel_worker():
+        nonlocal completed_channels
+        while True:
+            try:
+                index, channel = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                async with global_channel_slots():
+                    results[index] = await worker(channel)
+            finally:
+                completed_channels += 1
+
+    concurrency = max(1, concurrency or BACKUP_CONCURRENCY)
+    updater_task = asyncio.create_task(progress_updater())
+    workers = [asyncio.create_task(channel_worker()) for _ in range(min(concurrency, total_channels))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        updater_task.cancel()
+        await asyncio.gather(*workers, updater_task, return_exceptions=True)
+    return results
+
+
+def iter_ndjson(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+JSON_WHITESPACE = re.compile(r"\s*")
+JSON_SKIP_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]')
+JSON_NON_BRACKETS = bytes(set(range(256)) - set(b"[]{}"))
+JSON_DEPTH = {ord("["): 1, ord("{"): 1, ord("]"): -1, ord("}"): -1}
+
+
+class JsonStreamScanner:
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f, offset=0, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        f.seek(offset)
+        self.base = offset
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def tell(self):
+        return self.base + len(self.buf[:self.pos].encode("utf-8"))
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        self.eof = not chunk
+        self.base = self.tell()
+        self.buf = self.buf[self.pos:] + self.text_decoder.decode(chunk, final=self.eof)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("JSON troncato")
+
+    def expect(self, token):
+        if self.peek() != token:
+            raise ValueError(f"Atteso {token!r} alla posizione {self.tell()}")
+        self.pos += 1
+
+    def next_item(self, closing):
+        token = self.peek()
+        if token == ",":
+            self.pos += 1
+            token = self.peek()
+        if token == closing:
+            self.pos += 1
+            return False
+        return True
+
+    def load_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+            if end >= len(self.buf) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def skip_array(self):
+        self.expect("[")
+        depth = 1
+        count = 0
+        while True:
+            plain = self.buf.replace("\\\\", "__").replace('\\"', "__")
+            end = len(plain)
+            if plain.count('"', self.pos) % 2:
+                end = plain.rfind('"')
+            outside = "".join(plain[self.pos:end].split('"')[::2])
+            brackets = outside.encode().translate(None, JSON_NON_BRACKETS)
+            depths = list(itertools.accumulate(map(JSON_DEPTH.__getitem__, brackets), initial=depth))
+            if 0 in depths:
+                break
+            count += depths.count(1) - (depth == 1)
+            depth = depths[-1]
+            self.pos = end
+            if not self.fill():
+                raise ValueError("JSON troncato")
+        for match in JSON_SKIP_TOKEN.finditer(self.buf, self.pos, end):
+            token = match.group()
+            if token[0] == '"':
+                continue
+            depth += JSON_DEPTH[ord(token)]
+            if depth == 1:
+                count += 1
+            elif depth == 0:
+                self.pos = match.end()
+                return count
+
+
+class EmbedLookup:
+    cache_size = 1024
+
+    def __init__(self, backup_dir):
+        self.data_path = backup_dir / EmbedStore.file_name
+        self.index_path = backup_dir / EmbedStore.index_name
+        self.cache = collections.OrderedDict()
+        self.conn = None
+        self.file = None
+
+    def get(self, embed_hash):
+        if embed_hash in self.cache:
+            self.cache.move_to_end(embed_hash)
+            return self.cache[embed_hash]
+        if self.conn is None:
+            if not self.index_path.exists() or not self.data_path.exists():
+                return None
+            self.conn = sqlite3.connect(f"{self.index_path.resolve().as_uri()}?mode=ro", uri=True)
+            self.file = open(self.data_path, "rb")
+        row = self.conn.execute("SELECT offset, length FROM embeds WHERE hash = ?", (embed_hash,)).fetchone()
+        if row is None:
+            return None
+        self.file.seek(row[0])
+        try:
+            embed = json.loads(self.file.read(row[1])).get("embed")
+        except ValueError:
+            return None
+        self.cache[embed_hash] = embed
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return embed
+
+    def resolve(self, msg):
+        embeds = msg.get("embeds")
+        if embeds and any(isinstance(item, str) for item in embeds):
+            resolved = (self.get(item) if isinstance(item, str) else item for item in embeds)
+            msg["embeds"] = [embed for embed in resolved if embed is not None]
+        return msg
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.file.close()
+            self.conn = None
+            self.file = None
+
+
+class JsonBackupReader:
+    def __init__(self, backup_dir, data_path):
+        self.backup_dir = backup_dir
+        self.data_path = data_path
+        self.header = None
+        self.channel_list = None
+        self.resolve_embeds = True
+
+    def load(self):
+        with open(self.data_path, "rb") as f:
+            scanner = JsonStreamScanner(f)
+            scanner.expect("{")
+            header = {}
+            channel_list = []
+            while scanner.next_item("}"):
+                key = scanner.load_value()
+                scanner.expect(":")
+                if key != "channels":
+                    header[key] = scanner.load_value()
+                    continue
+                scanner.expect("[")
+                while scanner.next_item("]"):
+                    channel_list.append(self.index_channel(scanner))
+        self.header = header
+        self.channel_list = channel_list
+        return self
+
+    def index_channel(self, scanner):
+        scanner.expect("{")
+        ch = {}
+        while scanner.next_item("}"):
+            key = scanner.load_value()
+            scanner.expect(":")
+            if key != "messages":
+                ch[key] = scanner.load_value()
+                continue
+            ch["messages_offset"] = scanner.tell()
+            ch.setdefault("message_count", scanner.skip_array())
+        return ch
+
+    @property
+    def version(self):
+        return self.header.get("version", 1)
+
+    def channels(self):
+        for ch in self.channel_list:
+            yield ch, ch.get("message_count", 0)
+
+    def messages(self, ch):
+        if self.version >= 2:
+            messages_path = self.backup_dir / ch.get("file", "")
+            if not ch.get("file") or not messages_path.exists():
+                return
+            lookup = EmbedLookup(self.backup_dir)
+            try:
+                for msg in iter_ndjson(messages_path):
+                    yield lookup.resolve(msg) if self.resolve_embeds else msg
+            finally:
+                lookup.close()
+            return
+        if "messages_offset" not in ch:
+            return
+        with open(self.data_path, "rb") as f:
+            scanner = JsonStreamScanner(f, ch["messages_offset"], chunk_size=1 << 16)
+            scanner.expect("[")
+            while scanner.next_item("]"):
+                yield scanner.load_value()
+
+
+class SqliteBackupReader:
+    page_size = 500
+
+    def __init__(self, backup_dir, db_path):
+        self.backup_dir = backup_dir
+        self.db_path = db_path
+        self.channel_list = None
+        self.resolve_embeds = True
+        self.embed_refs = False
+
+    def connect(self):
+        return sqlite3.connect(f"{Path(self.db_path).resolve().as_uri()}?mode=ro", uri=True)
+
+    def load(self):
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                "SELECT channel_id, COUNT(*) FROM messages WHERE author_id != 0 GROUP BY channel_id ORDER BY channel_id"
+            ).fetchall()
+            self.embed_refs = "embed_hash" in {row[1] for row in conn.execute("PRAGMA table_info(embeds)")}
+        finally:
+            conn.close()
+        self.channel_list = [{"id": channel_id, "message_count": count} for channel_id, count in rows]
+        return self
+
+    def channels(self):
+        for ch in self.channel_list:
+            yield ch, ch["message_count"]
+
+    def messages(self, ch):
+        conn = self.connect()
+        try:
+            last_id = 0
+            while True:
+                rows = conn.execute(
+                    "SELECT id, author_id, author_tag, content, created_at FROM messages "
+                    "WHERE channel_id = ? AND id > ? AND author_id != 0 ORDER BY id LIMIT ?",
+                    (ch["id"], last_id, self.page_size),
+                ).fetchall()
+                if not rows:
+                    return
+                page = {}
+                for message_id, author_id, author_tag, content, created_at in rows:
+                    page[message_id] = {
+                        "id": message_id,
+                        "author_id": author_id,
+                        "author_tag": author_tag,
+                        "content": content,
+                        "created_at": created_at,
+                        "embeds": [],
+                        "attachments": [],
+                    }
+                params = (ch["id"], last_id, rows[-1][0])
+                if self.embed_refs:
+                    embed_query = (
+                        "SELECT e.message_id, e.embed_hash, COALESCE(p.payload, e.payload) FROM embeds e "
+                        "JOIN messages m ON m.id = e.message_id LEFT JOIN embed_payloads p ON p.hash = e.embed_hash "
+                        "WHERE m.channel_id = ? AND m.id > ? AND m.id <= ? ORDER BY e.id"
+                    )
+                else:
+                    embed_query = (
+                        "SELECT e.message_id, NULL, e.payload FROM embeds e JOIN messages m ON m.id = e.message_id "
+                        "WHERE m.channel_id = ? AND m.id > ? AND m.id <= ? ORDER BY e.id"
+                    )
+                for message_id, embed_hash, payload in conn.execute(embed_query, params):
+                    try:
+                        page[message_id]["embeds"].append(
+                            embed_hash if embed_hash and not self.resolve_embeds else json.loads(payload)
+                        )
+                    except (KeyError, TypeError, ValueError):
+                        continue
+                for message_id, filename, saved_path, error in conn.execute(
+                    "SELECT a.message_id, a.filename, a.saved_path, a.error FROM attachments a JOIN messages m ON m.id = a.message_id "
+                    "WHERE m.channel_id = ? AND m.id > ? AND m.id <= ? ORDER BY a.id",
+                    params,
+                ):
+                    if message_id in page:
+                        page[message_id]["attachments"].append(
+                            {"filename": filename, "saved_path": saved_path, "error": error}
+                        )
+                last_id = rows[-1][0]
+                yield from page.values()
+        finally:
+            conn.close()
+
+
+GZIP_HEADER = struct.Struct("<BBBBIBBH")
+GZIP_SUBFIELD = struct.Struct("<2sH")
+GZIP_TRAILER = struct.Struct("<II")
+ARCHIVE_FIELDS = {
+    b"BA": struct.Struct("<QQQII"),
+    b"BI": struct.Struct("<Q"),
+    b"BF": struct.Struct("<QQQ"),
+}
+
+
+def gzip_member(data, tag, *fields):
+    field_struct = ARCHIVE_FIELDS[tag]
+    compressor = zlib.compressobj(BACKUP_ARCHIVE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    size = GZIP_HEADER.size + GZIP_SUBFIELD.size + field_struct.size + len(body) + GZIP_TRAILER.size
+    extra = GZIP_SUBFIELD.pack(tag, field_struct.size) + field_struct.pack(*fields, size)
+    return (
+        GZIP_HEADER.pack(0x1F, 0x8B, 8, 4, 0, 0, 255, len(extra))
+        + extra
+        + body
+        + GZIP_TRAILER.pack(zlib.crc32(data), len(data) & 0xFFFFFFFF)
+    )
+
+
+ARCHIVE_FOOTER_SIZE = len(gzip_member(b"", b"BF", 0, 0))
+
+
+def read_archive_member(f, offset):
+    f.seek(offset)
+    head = f.read(GZIP_HEADER.size + GZIP_SUBFIELD.size)
+    if len(head) < GZIP_HEADER.size + GZIP_SUBFIELD.size:
+        return None, None
+    id1, id2, method, flags, _, _, _, _ = GZIP_HEADER.unpack_from(head)
+    tag, length = GZIP_SUBFIELD.unpack_from(head, GZIP_HEADER.size)
+    field_struct = ARCHIVE_FIELDS.get(tag)
+    if (id1, id2, method) != (0x1F, 0x8B, 8) or not flags & 4 or field_struct is None or length != field_struct.size:
+        return None, None
+    data = f.read(length)
+    if len(data) < length:
+        return None, None
+    return tag, field_struct.unpack(data)
+
+
+def scan_archive_blocks(f, file_size):
+    blocks = []
+    offset = 0
+    while True:
+        tag, fields = read_archive_member(f, offset)
+        if tag != b"BA" or offset + fields[-1] > file_size:
+            return blocks, offset
+        channel_id, first_id, last_id, count, size = fields
+        blocks.append((channel_id, [offset, size, first_id, last_id, count]))
+        offset += size
+
+
+class ArchiveBackupReader(JsonBackupReader):
+    def load(self):
+        file_size = os.path.getsize(self.data_path)
+        with open(self.data_path, "rb") as f:
+            tag, fields = read_archive_member(f, max(0, file_size - ARCHIVE_FOOTER_SIZE))
+            if tag == b"BF":
+                f.seek(fields[0])
+                index = json.loads(zlib.decompress(f.read(fields[1]), 16 + zlib.MAX_WBITS))
+            else:
+                blocks, _ = scan_archive_blocks(f, file_size)
+                channels = {}
+                for channel_id, block in blocks:
+                    channels.setdefault(channel_id, {"id": channel_id, "message_count": 0, "blocks": []})
+                    channels[channel_id]["blocks"].append(block)
+                    channels[channel_id]["message_count"] += block[4]
+                index = {"channels": list(channels.values())}
+        self.channel_list = index.pop("channels", [])
+        self.header = index
+        return self
+
+    def messages(self, ch):
+        lookup = EmbedLookup(self.backup_dir)
+        try:
+            with open(self.data_path, "rb") as f:
+                for offset, size, *_ in ch.get("blocks", []):
+                    f.seek(offset)
+                    for line in zlib.decompress(f.read(size), 16 + zlib.MAX_WBITS).decode("utf-8").split("\n"):
+                        if line:
+                            msg = json.loads(line)
+                            yield lookup.resolve(msg) if self.resolve_embeds else msg
+        finally:
+            lookup.close()
+
+
+def open_backup_reader(backup_dir, meta):
+    for method, reader_class in (("json", JsonBackupReader), ("db", SqliteBackupReader), ("archive", ArchiveBackupReader)):
+        data_file_name = backup_data_file(meta, method)
+        if data_file_name and (backup_dir / data_file_name).exists():
+            return reader_class(backup_dir, backup_dir / data_file_name).load()
+    return None
+
+
+def has_search_index(db_path):
+    conn = sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is not None
+    finally:
+        conn.close()
+
+
+def structure_channel_names(backup_dir, meta):
+    structure_path = backup_dir / (meta.get("structure_file") or "backup_structure.json")
+    if not structure_path.exists():
+        return {}
+    return {ch["id"]: ch.get("name") for ch in read_json_file(structure_path).get("channels", [])}
+
+
+def build_search_index(backup_dir, meta):
+    reader = open_backup_reader(backup_dir, meta)
+    if reader is None:
+        return None
+    channel_names = structure_channel_names(backup_dir, meta)
+    index_path = backup_dir / SEARCH_INDEX_FILE
+    tmp_path = index_path.with_name(index_path.name + ".tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+    writer = SqliteBackupWriter(tmp_path)
+    try:
+        for ch, _ in reader.channels():
+            writer.add_channel(ch.get("id"), ch.get("name") or channel_names.get(ch.get("id")))
+            for msg in reader.messages(ch):
+                writer.add_message(
+                    (
+                        msg.get("id"),
+                        ch.get("id"),
+                        msg.get("author_id"),
+                        msg.get("author_tag"),
+                        msg.get("content"),
+                        msg.get("created_at"),
+                    )
+                )
+        writer.finish()
+    finally:
+        writer.close()
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+def write_viewer_page(bundle_dir, channel_id, number, messages, lookup):
+    relative_path = Path(str(channel_id)) / f"page_{number:05d}.json"
+    page_path = bundle_dir / relative_path
+    page_path.parent.mkdir(exist_ok=True)
+    embeds = {}
+    for msg in messages:
+        for item in msg.get("embeds") or []:
+            if isinstance(item, str) and item not in embeds:
+                embeds[item] = lookup.get(item)
+    with open(page_path, "w", encoding="utf-8") as f:
+        json.dump({"messages": messages, "embeds": embeds}, f, ensure_ascii=False, separators=(",", ":"))
+    return {
+        "file": (Path(VIEWER_BUNDLE_DIR) / relative_path).as_posix(),
+        "count": len(messages),
+        "first_id": messages[0].get("id"),
+        "last_id": messages[-1].get("id"),
+        "first_at": messages[0].get("created_at"),
+        "last_at": messages[-1].get("created_at"),
+        "authors": len({msg.get("author_id") for msg in messages}),
+        "attachments": sum(len(msg.get("attachments") or []) for msg in messages),
+        "embeds": sum(len(msg.get("embeds") or []) for msg in messages),
+    }
+
+
+def write_viewer_bundle(backup_dir, meta):
+    reader = open_backup_reader(backup_dir, meta)
+    if reader is None:
+        return None
+    reader.resolve_embeds = False
+    lookup = EmbedLookup(backup_dir)
+    channel_names = structure_channel_names(backup_dir, meta)
+    bundle_dir = backup_dir / VIEWER_BUNDLE_DIR
+    tmp_dir = bundle_dir.with_name(bundle_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir()
+    channels = []
+    try:
+        for ch, _ in reader.channels():
+            pages = []
+            page = []
+            for msg in reader.messages(ch):
+                page.append(msg)
+                if len(page) >= VIEWER_PAGE_SIZE:
+                    pages.append(write_viewer_page(tmp_dir, ch.get("id"), len(pages), page, lookup))
+                    page = []
+            if page:
+                pages.append(write_viewer_page(tmp_dir, ch.get("id"), len(pages), page, lookup))
+            channels.append(
+                {
+                    "id": ch.get("id"),
+                    "name": ch.get("name") or channel_names.get(ch.get("id")),
+                    "message_count": sum(page["count"] for page in pages),
+                    "pages": pages,
+                }
+            )
+    finally:
+        lookup.close()
+    with open(tmp_dir / "index.json", "w", encoding="utf-8") as f:
+        json.dump({"version": 2, "page_size": VIEWER_PAGE_SIZE, "channels": channels}, f, ensure_ascii=False)
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+    os.replace(tmp_dir, bundle_dir)
+    return bundle_dir / "index.json"
+
+
+def find_search_index(backup_dir, meta, build=False):
+    db_name = backup_data_file(meta, "db")
+    if db_name and (backup_dir / db_name).exists() and has_search_index(backup_dir / db_name):
+        return backup_dir / db_name
+    if (backup_dir / SEARCH_INDEX_FILE).exists():
+        return backup_dir / SEARCH_INDEX_FILE
+    if build:
+        return build_search_index(backup_dir, meta)
+    return None
+
+
+def fts_query(text):
+    terms = []
+    for term in text.split():
+        prefix = term.endswith("*")
+        term = term.rstrip("*")
+        if term:
+            terms.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def search_index(db_path, query, limit=None):
+    conn = sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        return conn.execute(
+            "SELECT m.id, m.channel_id, c.name, m.author_tag, m.created_at, m.content, bm25(messages_fts) AS score "
+            "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+            "LEFT JOIN channels c ON c.id = m.channel_id "
+            "WHERE messages_fts MATCH ? ORDER BY score LIMIT ?",
+            (query, limit or SEARCH_RESULTS),
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def channel_history_kwargs(channel, mode, after_ids=None):
+    limit = None
+    if mode == "rapido":
+        limit = 500
+    history_kwargs = {"limit": limit, "oldest_first": True}
+    after_id = (after_ids or {}).get(str(channel.id))
+    if after_id:
+        history_kwargs["after"] = discord.Object(id=int(after_id))
+    return history_kwargs
+
+
+def is_metadata_file(path):
+    return (
+        path.suffix.lower() == ".json"
+        and path.name.startswith("backup_")
+        and path.name not in ("backup_data.json", "backup_structure.json")
+    )
+
+
+def find_metadata_path(name):
+    meta_path = Path(name)
+    if not meta_path.is_absolute():
+        meta_path = Path.cwd() / meta_path
+    if meta_path.is_dir():
+        return next((p for p in sorted(meta_path.glob("backup_*.json")) if is_metadata_file(p)), meta_path)
+    if meta_path.suffix.lower() != ".json":
+        return meta_path.with_suffix(".json")
+    return meta_path
+
+
+def read_json_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def find_latest_backup(guild_id, methods, root=None):
+    latest = None
+    for meta_path in Path(root or Path.cwd()).glob("backup_*/backup_*.json"):
+        if not is_metadata_file(meta_path):
+            continue
+        try:
+            meta = read_json_file(meta_path)
+        except Exception:
+            continue
+        if str(meta.get("guild_id")) != str(guild_id) or set(backup_methods(meta)) != set(methods):
+            continue
+        if not meta.get("channels_last_message_id"):
+            continue
+        if latest is None or meta.get("created_at", "") > latest[1].get("created_at", ""):
+            latest = (meta_path, meta)
+    return latest
+
+
+def load_backup_chain(meta_path, meta):
+    chain = [(meta_path.parent, meta)]
+    seen = {meta_path.resolve()}
+    while meta.get("parent"):
+        meta_path = (meta_path.parent / meta["parent"]).resolve()
+        if meta_path in seen:
+            raise ValueError("Catena di backup circolare")
+        seen.add(meta_path)
+        meta = read_json_file(meta_path)
+        chain.append((meta_path.parent, meta))
+    chain.reverse()
+    return chain
+
+
+class CheckpointJournal:
+    file_name = "checkpoint.jsonl"
+
+    def __init__(self, backup_dir):
+        self.path = backup_dir / self.file_name
+        self.job = None
+        self.channels = {}
+        self.complete = False
+        if self.path.exists():
+            for entry in iter_ndjson(self.path):
+                if entry.get("type") == "start":
+                    self.job = entry
+                elif entry.get("type") == "channel":
+                    self.channels[str(entry["channel_id"])] = entry
+                elif entry.get("type") == "complete":
+                    self.complete = True
+        self.file = None
+
+    def record(self, **entry):
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def start(self, **job):
+        self.job = {"type": "start", **job}
+        self.record(**self.job)
+
+    def channel_state(self, channel_id):
+        return self.channels.get(str(channel_id))
+
+    def checkpoint(self, channel_id, last_message_id, count, positions=None, done=False):
+        entry = {
+            "type": "channel",
+            "channel_id": channel_id,
+            "last_message_id": last_message_id,
+            "count": count,
+            "positions": positions or {},
+            "done": done,
+        }
+        self.channels[str(channel_id)] = entry
+        self.record(**entry)
+
+    def resume_after_ids(self, after_ids):
+        resumed = dict(after_ids or {})
+        for channel_id, state in self.channels.items():
+            if state.get("last_message_id"):
+                resumed[channel_id] = state["last_message_id"]
+        return resumed
+
+    def finish(self):
+        self.record(type="complete")
+        self.complete = True
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def open_channel_file(path, offset):
+    if offset is not None and path.exists():
+        os.truncate(path, offset)
+        return open(path, "a", encoding="utf-8")
+    return open(path, "w", encoding="utf-8")
+
+
 def default_backup_options(method, mode):
-    normalized_method = (method or "json").lower()
+    normalized_methods = []
+    for name in (method or "json").lower().replace("+", ",").split(","):
+        name = name.strip()
+        if name in BACKUP_SINKS and name not in normalized_methods:
+            normalized_methods.append(name)
     normalized_mode = (mode or "rapido").lower()
-    if normalized_method not in ("json", "txt", "db"):
-        normalized_method = "json"
+    if not normalized_methods:
+        normalized_methods = ["json"]
     if normalized_mode not in ("rapido", "full"):
         normalized_mode = "rapido"
-    return normalized_method, normalized_mode
+    return normalized_methods, normalized_mode
 
 
-async def backup_guild_structure(guild, backup_dir):
+def backup_methods(meta):
+    return meta.get("methods") or [meta.get("method", "json").lower()]
+
+
+def backup_data_file(meta, method):
+    data_files = meta.get("data_files")
+    if data_files is not None:
+        return data_files.get(method)
+    if meta.get("method", "json").lower() == method:
+        return meta.get("data_file")
+    return None
+
+
+def guild_structure(guild):
     info = {
         "guild_id": guild.id,
         "guild_name": guild.name,
@@ -131,295 +980,1951 @@ async def backup_guild_structure(guild, backup_dir):
         "emojis": emojis,
         "version": 1,
     }
+    return structure
+
+
+async def backup_guild_structure(guild, backup_dir):
+    structure = guild_structure(guild)
     structure_path = backup_dir / "backup_structure.json"
     with open(structure_path, "w", encoding="utf-8") as f:
         json.dump(structure, f, ensure_ascii=False, indent=2)
     return structure_path
 
 
-async def backup_messages_txt(guild, backup_dir, mode, progress_msg):
-    text_channels = guild.text_channels
-    total_channels = len(text_channels)
-    completed_channels = 0
-    media_dir = backup_dir / "media"
-    logs_dir = backup_dir / "logs"
-    media_dir.mkdir(exist_ok=True)
-    logs_dir.mkdir(exist_ok=True)
-
-    async def progress_updater():
-        while completed_channels < total_channels:
-            bar = generate_progress_bar(completed_channels, total_channels)
-            await progress_msg.edit(content=f"📨 Backup messaggi TXT: {bar}")
-            await asyncio.sleep(2)
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    updater_task = asyncio.create_task(progress_updater())
 
+def link_or_copy(source, target):
+    if target.exists():
+        target.unlink()
     try:
-        for channel in text_channels:
-            safe_name = sanitize_name(channel.name) or str(channel.id)
-            log_path = logs_dir / f"{safe_name}.txt"
-            channel_media_dir = media_dir / safe_name
-            channel_media_dir.mkdir(exist_ok=True)
-            try:
-                limit = None
-                if mode == "rapido":
-                    limit = 500
-                history_kwargs = {"limit": limit, "oldest_first": True}
-                with open(log_path, "w", encoding="utf-8") as f:
-                    async for msg in channel.history(**history_kwargs):
-                        timestamp = msg.created_at.isoformat()
-                        author = f"{msg.author} ({msg.author.id})"
-                        content = msg.clean_content or ""
-                        f.write(f"[{timestamp}] {author}: {content}\n")
-                        if msg.embeds:
-                            for idx, embed in enumerate(msg.embeds, start=1):
-                                embed_dict = embed.to_dict()
-                                f.write(f"[EMBED {idx}] {json.dumps(embed_dict, ensure_ascii=False)}\n")
-                        if mode == "full":
-                            for att in msg.attachments:
-                                try:
-                                    target = channel_media_dir / att.filename
-                                    await att.save(target)
-                                    f.write(f"[ATTACHMENT] {att.filename} -> {target.as_posix()}\n")
-                                except Exception as e:
-                                    f.write(f"[ATTACHMENT ERROR] {att.filename} - {e}\n")
-            except Exception as e:
-                error_log = logs_dir / "errors.txt"
-                with open(error_log, "a", encoding="utf-8") as ef:
-                    ef.write(f"Errore salvataggio canale {channel.id} ({channel.name}): {e}\n")
-            completed_channels += 1
-    finally:
-        updater_task.cancel()
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
 
 
-async def backup_messages_json(guild, backup_dir, mode, progress_msg):
-    text_channels = guild.text_channels
-    total_channels = len(text_channels)
-    completed_channels = 0
-    media_dir = backup_dir / "media"
-    media_dir.mkdir(exist_ok=True)
-    data = {
-        "guild_id": guild.id,
-        "created_at": datetime.utcnow().isoformat(),
-        "mode": mode,
-        "channels": [],
-        "version": 1,
-    }
+class MediaStore:
+    def __init__(self, root=None):
+        self.root = Path(root or MEDIA_STORE_DIR)
+        self.objects_dir = self.root / "objects"
+        self.tmp_dir = self.root / "tmp"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(exist_ok=True)
+        self.conn = sqlite3.connect(self.root / "index.db", timeout=30)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS attachments (attachment_id INTEGER PRIMARY KEY, size INTEGER, sha256 TEXT)"
+        )
+        self.conn.commit()
 
-    async def progress_updater():
-        while completed_channels < total_channels:
-            bar = generate_progress_bar(completed_channels, total_channels)
-            await progress_msg.edit(content=f"📨 Backup messaggi JSON: {bar}")
-            await asyncio.sleep(2)
+    def object_path(self, sha256):
+        return self.objects_dir / sha256[:2] / sha256
 
-    updater_task = asyncio.create_task(progress_updater())
+    def lookup(self, att):
+        row = self.conn.execute("SELECT size, sha256 FROM attachments WHERE attachment_id = ?", (att.id,)).fetchone()
+        if row and row[0] == att.size and self.object_path(row[1]).exists():
+            return row[1]
+        return None
 
-    try:
-        for channel in text_channels:
-            safe_name = sanitize_name(channel.name) or str(channel.id)
-            channel_media_dir = media_dir / safe_name
-            channel_media_dir.mkdir(exist_ok=True)
-            channel_entry = {
-                "id": channel.id,
-                "name": channel.name,
-                "category_id": channel.category.id if channel.category else None,
-                "messages": [],
-            }
-            try:
-                limit = None
-                if mode == "rapido":
-                    limit = 500
-                history_kwargs = {"limit": limit, "oldest_first": True}
-                async for msg in channel.history(**history_kwargs):
-                    msg_payload = {
-                        "id": msg.id,
-                        "author_id": msg.author.id,
-                        "author_tag": str(msg.author),
-                        "content": msg.clean_content or "",
-                        "created_at": msg.created_at.isoformat(),
-                        "embeds": [embed.to_dict() for embed in msg.embeds],
-                        "attachments": [],
-                    }
-                    if mode == "full":
-                        for att in msg.attachments:
-                            attachment_path = channel_media_dir / att.filename
-                            try:
-                                await att.save(attachment_path)
-                                msg_payload["attachments"].append(
-                                    {
-                                        "filename": att.filename,
-                                        "saved_path": str(attachment_path.relative_to(backup_dir)),
-                                    }
-                                )
-                            except Exception as e:
-                                msg_payload["attachments"].append(
-                                    {
-                                        "filename": att.filename,
-                                        "error": str(e),
-                                    }
-                                )
-                    channel_entry["messages"].append(msg_payload)
-            except Exception as e:
-                channel_entry["error"] = str(e)
-            data["channels"].append(channel_entry)
-            completed_channels += 1
-    finally:
-        updater_task.cancel()
-    data_path = backup_dir / "backup_data.json"
-    with open(data_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    return data_path
+    async def download(self, att):
+        fd, tmp_name = tempfile.mkstemp(dir=self.tmp_dir, suffix=".part")
+        os.close(fd)
+        tmp_path = Path(tmp_name)
+        try:
+            await att.save(tmp_path)
+            sha256 = await asyncio.to_thread(hash_file, tmp_path)
+            object_path = self.object_path(sha256)
+            object_path.parent.mkdir(exist_ok=True)
+            if not object_path.exists():
+                os.replace(tmp_path, object_path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO attachments (attachment_id, size, sha256) VALUES (?, ?, ?)",
+                (att.id, att.size, sha256),
+            )
+        return sha256
 
+    def link(self, sha256, target):
+        link_or_copy(self.object_path(sha256), target)
 
-async def backup_messages_db(guild, backup_dir, mode, progress_msg):
-    db_path = backup_dir / "backup.db"
-    conn = sqlite3.connect(db_path)
-    conn.execute(
-        "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, channel_id INTEGER, author_id INTEGER, author_tag TEXT, content TEXT, created_at TEXT)"
-    )
-    conn.execute(
-        "CREATE TABLE IF NOT EXISTS embeds (id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER, payload TEXT)"
-    )
-    conn.execute(
-        "CREATE TABLE IF NOT EXISTS attachments (id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER, filename TEXT, saved_path TEXT, error TEXT)"
-    )
-    conn.commit()
-    text_channels = guild.text_channels
-    total_channels = len(text_channels)
-    completed_channels = 0
-    media_dir = backup_dir / "media"
-    media_dir.mkdir(exist_ok=True)
+    def linked_digest(self, attachment_id, st):
+        row = self.conn.execute("SELECT sha256 FROM attachments WHERE attachment_id = ?", (attachment_id,)).fetchone()
+        if row is None:
+            return None
+        try:
+            object_st = self.object_path(row[0]).stat()
+        except OSError:
+            return None
+        return row[0] if (object_st.st_dev, object_st.st_ino) == (st.st_dev, st.st_ino) else None
 
-    async def progress_updater():
-        while completed_channels < total_channels:
-            bar = generate_progress_bar(completed_channels, total_channels)
-            await progress_msg.edit(content=f"📨 Backup messaggi DB: {bar}")
-            await asyncio.sleep(2)
+    def close(self):
+        self.conn.close()
 
-    updater_task = asyncio.create_task(progress_updater())
 
-    try:
-        for channel in text_channels:
-            safe_name = sanitize_name(channel.name) or str(channel.id)
-            channel_media_dir = media_dir / safe_name
-            channel_media_dir.mkdir(exist_ok=True)
+class AttachmentDownloader:
+    def __init__(self, backup_dir, store=None, concurrency=None):
+        self.backup_dir = backup_dir
+        self.store = store or MediaStore()
+        self.queue = asyncio.Queue(maxsize=BACKUP_DOWNLOAD_QUEUE)
+        self.max_bytes = BACKUP_MAX_MEDIA_BYTES
+        self.bandwidth = BACKUP_MEDIA_BANDWIDTH
+        self.reserved_bytes = 0
+        self.downloaded_bytes = 0
+        self.available_at = 0.0
+        self.workers = [
+            asyncio.create_task(self.worker())
+            for _ in range(max(1, concurrency or BACKUP_DOWNLOAD_CONCURRENCY))
+        ]
+
+    async def submit(self, att, target):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((att, target, future))
+        return future
+
+    async def worker(self):
+        while True:
+            att, target, future = await self.queue.get()
             try:
-                limit = None
-                if mode == "rapido":
-                    limit = 500
-                history_kwargs = {"limit": limit, "oldest_first": True}
-                async for msg in channel.history(**history_kwargs):
-                    conn.execute(
-                        "INSERT OR REPLACE INTO messages (id, channel_id, author_id, author_tag, content, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                        (
-                            msg.id,
-                            channel.id,
-                            msg.author.id,
-                            str(msg.author),
-                            msg.clean_content or "",
-                            msg.created_at.isoformat(),
-                        ),
-                    )
-                    for embed in msg.embeds:
-                        conn.execute(
-                            "INSERT INTO embeds (message_id, payload) VALUES (?, ?)",
-                            (msg.id, json.dumps(embed.to_dict(), ensure_ascii=False)),
-                        )
-                    if mode == "full":
-                        for att in msg.attachments:
-                            attachment_path = channel_media_dir / att.filename
-                            error = None
-                            try:
-                                await att.save(attachment_path)
-                            except Exception as e:
-                                error = str(e)
-                            conn.execute(
-                                "INSERT INTO attachments (message_id, filename, saved_path, error) VALUES (?, ?, ?, ?)",
-                                (
-                                    msg.id,
-                                    att.filename,
-                                    str(attachment_path.relative_to(backup_dir)),
-                                    error,
-                                ),
-                            )
-                conn.commit()
+                result = await self.fetch(att, target)
             except Exception as e:
-                conn.execute(
-                    "INSERT INTO messages (id, channel_id, author_id, author_tag, content, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                    (
-                        None,
-                        channel.id,
-                        0,
-                        "system",
-                        f"Errore durante il backup del canale {channel.id} ({channel.name}): {e}",
-                        datetime.utcnow().isoformat(),
-                    ),
-                )
-                conn.commit()
-            completed_channels += 1
-    finally:
-        updater_task.cancel()
-        conn.close()
-    return db_path
+                result = {"filename": att.filename, "error": str(e)}
+            if not future.done():
+                future.set_result(result)
+            self.queue.task_done()
 
+    async def throttle(self, size):
+        if not self.bandwidth:
+            return
+        loop = asyncio.get_running_loop()
+        start = max(loop.time(), self.available_at)
+        self.available_at = start + size / self.bandwidth
+        delay = start - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
 
-async def create_metadata_file(backup_dir, guild, method, mode, structure_path, data_path):
-    timestamp = datetime.utcnow().isoformat()
-    meta = {
-        "guild_id": guild.id,
-        "guild_name": guild.name,
-        "created_at": timestamp,
-        "method": method,
-        "mode": mode,
-        "structure_file": str(structure_path.name),
-        "data_file": str(data_path.name) if data_path else None,
-        "version": 1,
-    }
+    async def fetch(self, att, target):
+        sha256 = self.store.lookup(att)
+        if sha256 is None:
+            if self.max_bytes and self.reserved_bytes + att.size > self.max_bytes:
+                return {"filename": att.filename, "error": "Limite di dimensione del backup raggiunto, allegato saltato"}
+            self.reserved_bytes += att.size
+            try:
+                sha256 = await self.download_with_retries(att)
+            except Exception:
+                self.reserved_bytes -= att.size
+                raise
+            self.downloaded_bytes += att.size
+        self.store.link(sha256, target)
+        return {
+            "filename": att.filename,
+            "saved_path": str(target.relative_to(self.backup_dir)),
+            "size": att.size,
+            "sha256": sha256,
+        }
+
+    async def download_with_retries(self, att):
+        attempt = 0
+        while True:
+            await self.throttle(att.size)
+            try:
+                return await self.store.download(att)
+            except (discord.NotFound, discord.Forbidden):
+                raise
+            except Exception:
+                attempt += 1
+                if attempt > BACKUP_DOWNLOAD_RETRIES:
+                    raise
+                await asyncio.sleep(min(30, 2 ** (attempt - 1)) + random.random())
+
+    async def close(self):
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.store.close()
+
+
+class OrderedMessageWriter:
+    def __init__(self, write, max_pending=None):
+        self.write = write
+        self.max_pending = max_pending or BACKUP_PENDING_MESSAGES
+        self.pending = collections.deque()
+
+    async def add(self, item, futures=()):
+        self.pending.append((item, list(futures)))
+        self.write_ready()
+        while len(self.pending) > self.max_pending:
+            await asyncio.gather(*self.pending[0][1])
+            self.write_ready()
+
+    def write_ready(self):
+        while self.pending and all(future.done() for future in self.pending[0][1]):
+            item, futures = self.pending.popleft()
+            self.write(item, [future.result() for future in futures])
+
+    async def close(self):
+        while self.pending:
+            await asyncio.gather(*self.pending[0][1])
+            self.write_ready()
+
+
+class BackgroundWriter:
+    def __init__(self, max_pending=None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="backup-writer")
+        self.max_pending = max_pending or BACKUP_WRITE_QUEUE
+        self.pending = collections.deque()
+        self.keyed = {}
+
+    def submit(self, fn, *args, key=None):
+        while self.pending and self.pending[0].done() and (self.pending[0].cancelled() or self.pending[0].exception() is None):
+            self.pending.popleft()
+        future = asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        self.pending.append(future)
+        if key is not None:
+            self.keyed.setdefault(key, []).append(future)
+        return future
+
+    async def run(self, fn, *args):
+        return await asyncio.shield(self.submit(fn, *args))
+
+    async def throttle(self):
+        while len(self.pending) >= self.max_pending:
+            await asyncio.wait([self.pending.popleft()])
+
+    async def wait(self, key):
+        results = await asyncio.shield(asyncio.gather(*self.keyed.pop(key, []), return_exceptions=True))
+        return next((result for result in results if isinstance(result, BaseException)), None)
+
+    async def drain(self):
+        while self.pending:
+            await asyncio.shield(self.pending.popleft())
+
+    async def close(self):
+        await asyncio.shield(asyncio.gather(*self.pending, return_exceptions=True))
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
+
+
+def attachment_target(channel_media_dir, att):
+    return channel_media_dir / f"{att.id}_{att.filename}"
+
+
+async def submit_attachments(downloader, channel_media_dir, msg):
+    if downloader is None:
+        return []
+    return [await downloader.submit(att, attachment_target(channel_media_dir, att)) for att in msg.attachments]
+
+
+class SqliteBackupWriter:
+    pragmas = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-65536",
+    )
+    schema = (
+        "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, channel_id INTEGER, author_id INTEGER, author_tag TEXT, content TEXT, created_at TEXT)",
+        "CREATE TABLE IF NOT EXISTS embeds (id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER, payload TEXT, embed_hash TEXT)",
+        "CREATE TABLE IF NOT EXISTS embed_payloads (hash TEXT PRIMARY KEY, payload TEXT)",
+        "CREATE TABLE IF NOT EXISTS attachments (id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER, filename TEXT, saved_path TEXT, error TEXT, size INTEGER, sha256 TEXT)",
+        "CREATE TABLE IF NOT EXISTS channels (id INTEGER PRIMARY KEY, name TEXT)",
+    )
+    search_schema = (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, author, channel, content='', tokenize='unicode61 remove_diacritics 2')",
+        "INSERT INTO messages_fts (messages_fts) VALUES ('delete-all')",
+        "INSERT INTO messages_fts (rowid, content, author, channel) "
+        "SELECT m.id, m.content, m.author_tag, c.name FROM messages m LEFT JOIN channels c ON c.id = m.channel_id WHERE m.author_id != 0",
+        "INSERT INTO messages_fts (messages_fts) VALUES ('optimize')",
+    )
+    indexes = (
+        "CREATE INDEX IF NOT EXISTS idx_messages_channel ON messages (channel_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_embeds_message ON embeds (message_id)",
+        "CREATE INDEX IF NOT EXISTS idx_attachments_message ON attachments (message_id)",
+    )
+
+    def __init__(self, db_path, batch_size=None):
+        self.existing = Path(db_path).exists()
+        self.conn = sqlite3.connect(db_path)
+        self.batch_size = max(1, batch_size or BACKUP_DB_BATCH_SIZE)
+        self.messages = []
+        self.embeds = []
+        self.embed_payloads = []
+        self.attachments = []
+        for pragma in self.pragmas:
+            self.conn.execute(pragma)
+        for statement in self.schema:
+            self.conn.execute(statement)
+        if "embed_hash" not in {row[1] for row in self.conn.execute("PRAGMA table_info(embeds)")}:
+            self.conn.execute("ALTER TABLE embeds ADD COLUMN embed_hash TEXT")
+        if self.conn.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0] == 0:
+            self.conn.execute("INSERT INTO schema_version (version) VALUES (?)", (DB_SCHEMA_VERSION,))
+        else:
+            self.conn.execute("UPDATE schema_version SET version = ? WHERE version < ?", (DB_SCHEMA_VERSION, DB_SCHEMA_VERSION))
+        self.conn.commit()
+
+    def pending(self):
+        return len(self.messages) + len(self.embeds) + len(self.embed_payloads) + len(self.attachments)
+
+    def add_message(self, row):
+        self.messages.append(row)
+        if self.pending() >= self.batch_size:
+            self.flush()
+
+    def add_embed(self, row):
+        self.embeds.append(row)
+
+    def add_embed_payloads(self, rows):
+        self.embed_payloads.extend(rows)
+
+    def add_attachment(self, row):
+        self.attachments.append(row)
+
+    def add_channel(self, channel_id, name):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO channels (id, name) VALUES (?, ?)", (channel_id, name))
+
+    def flush(self):
+        if not self.pending():
+            return
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO messages (id, channel_id, author_id, author_tag, content, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                self.messages,
+            )
+            self.conn.executemany("INSERT OR IGNORE INTO embed_payloads (hash, payload) VALUES (?, ?)", self.embed_payloads)
+            self.conn.executemany("INSERT INTO embeds (message_id, embed_hash) VALUES (?, ?)", self.embeds)
+            self.conn.executemany(
+                "INSERT INTO attachments (message_id, filename, saved_path, error, size, sha256) VALUES (?, ?, ?, ?, ?, ?)",
+                self.attachments,
+            )
+        self.messages = []
+        self.embeds = []
+        self.embed_payloads = []
+        self.attachments = []
+
+    def discard_channel_after(self, channel_id, last_message_id):
+        with self.conn:
+            params = (channel_id, last_message_id or 0)
+            self.conn.execute(
+                "DELETE FROM embeds WHERE message_id IN (SELECT id FROM messages WHERE channel_id = ? AND id > ?)",
+                params,
+            )
+            self.conn.execute(
+                "DELETE FROM attachments WHERE message_id IN (SELECT id FROM messages WHERE channel_id = ? AND id > ?)",
+                params,
+            )
+            self.conn.execute("DELETE FROM messages WHERE channel_id = ? AND id > ?", params)
+
+    def build_search_index(self):
+        try:
+            with self.conn:
+                for statement in self.search_schema:
+                    self.conn.execute(statement)
+        except sqlite3.OperationalError:
+            return False
+        return True
+
+    def finish(self):
+        self.flush()
+        for statement in self.indexes:
+            self.conn.execute(statement)
+        self.conn.execute("ANALYZE")
+        self.conn.commit()
+        self.build_search_index()
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+
+    def close(self):
+        self.conn.close()
+
+
+class TxtSink:
+    name = "txt"
+
+    def __init__(self, backup_dir, guild, mode, channel_names):
+        self.logs_dir = backup_dir / "logs"
+        self.logs_dir.mkdir(exist_ok=True)
+        self.channel_names = channel_names
+        self.files = {}
+
+    def skip_channel(self, channel, state):
+        pass
+
+    def write_embeds(self, entries):
+        pass
+
+    def open_channel(self, channel, state):
+        log_path = self.logs_dir / f"{self.channel_names[channel.id]}.txt"
+        self.files[channel.id] = open_channel_file(log_path, sink_position(state, self.name))
+
+    def write(self, channel, record):
+        f = self.files[channel.id]
+        f.write(f"[{record['created_at']}] {record['author_tag']} ({record['author_id']}): {record['content']}\n")
+        for idx, embed_hash in enumerate(record["embeds"], start=1):
+            f.write(f"[EMBED {idx}] #{embed_hash}\n")
+        for att in record["attachments"]:
+            if "error" in att:
+                f.write(f"[ATTACHMENT ERROR] {att['filename']} - {att['error']}\n")
+            else:
+                f.write(f"[ATTACHMENT] {att['filename']} -> {Path(att['saved_path']).as_posix()}\n")
+
+    def checkpoint(self, channel):
+        f = self.files[channel.id]
+        f.flush()
+        return f.tell()
+
+    def close_channel(self, channel, count, error=None):
+        f = self.files.pop(channel.id)
+        position = f.tell()
+        f.close()
+        if error:
+            error_log = self.logs_dir / "errors.txt"
+            with open(error_log, "a", encoding="utf-8") as ef:
+                ef.write(f"Errore salvataggio canale {channel.id} ({channel.name}): {error}\n")
+        return position
+
+    def finish(self):
+        return None
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+class JsonSink:
+    name = "json"
+
+    def __init__(self, backup_dir, guild, mode, channel_names):
+        self.backup_dir = backup_dir
+        self.messages_dir = backup_dir / "messages"
+        self.messages_dir.mkdir(exist_ok=True)
+        self.data = {
+            "guild_id": guild.id,
+            "created_at": datetime.utcnow().isoformat(),
+            "mode": mode,
+            "format": "ndjson",
+            "channels": [],
+            "embeds_file": EmbedStore.file_name,
+            "version": 2,
+        }
+        self.channel_order = [channel.id for channel in guild.text_channels]
+        self.entries = {}
+        self.files = {}
+
+    def channel_entry(self, channel, state):
+        messages_path = self.messages_dir / f"{channel.id}.ndjson"
+        entry = {
+            "id": channel.id,
+            "name": channel.name,
+            "category_id": channel.category.id if channel.category else None,
+            "file": messages_path.relative_to(self.backup_dir).as_posix(),
+            "message_count": state["count"] if state else 0,
+        }
+        self.entries[channel.id] = entry
+        return entry, messages_path
+
+    def skip_channel(self, channel, state):
+        self.channel_entry(channel, state)
+
+    def write_embeds(self, entries):
+        pass
+
+    def open_channel(self, channel, state):
+        _, messages_path = self.channel_entry(channel, state)
+        self.files[channel.id] = open_channel_file(messages_path, sink_position(state, self.name))
+
+    def write(self, channel, record):
+        self.files[channel.id].write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.entries[channel.id]["message_count"] += 1
+
+    def checkpoint(self, channel):
+        f = self.files[channel.id]
+        f.flush()
+        return f.tell()
+
+    def close_channel(self, channel, count, error=None):
+        f = self.files.pop(channel.id)
+        position = f.tell()
+        f.close()
+        if error:
+            self.entries[channel.id]["error"] = error
+        return position
+
+    def finish(self):
+        self.data["channels"] = [self.entries[channel_id] for channel_id in self.channel_order if channel_id in self.entries]
+        data_path = self.backup_dir / "backup_data.json"
+        with open(data_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        return data_path
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+class DbSink:
+    name = "db"
+
+    def __init__(self, backup_dir, guild, mode, channel_names):
+        self.db_path = backup_dir / "backup.db"
+        self.writer = SqliteBackupWriter(self.db_path)
+
+    def skip_channel(self, channel, state):
+        pass
+
+    def write_embeds(self, entries):
+        self.writer.add_embed_payloads(entries)
+
+    def open_channel(self, channel, state):
+        if self.writer.existing:
+            self.writer.discard_channel_after(channel.id, state.get("last_message_id") if state else None)
+        self.writer.add_channel(channel.id, channel.name)
+
+    def write(self, channel, record):
+        for embed_hash in record["embeds"]:
+            self.writer.add_embed((record["id"], embed_hash))
+        for att in record["attachments"]:
+            self.writer.add_attachment(
+                (
+                    record["id"],
+                    att["filename"],
+                    att.get("saved_path"),
+                    att.get("error"),
+                    att.get("size"),
+                    att.get("sha256"),
+                )
+            )
+        self.writer.add_message(
+            (
+                record["id"],
+                channel.id,
+                record["author_id"],
+                record["author_tag"],
+                record["content"],
+                record["created_at"],
+            )
+        )
+
+    def checkpoint(self, channel):
+        self.writer.flush()
+        return None
+
+    def close_channel(self, channel, count, error=None):
+        if error:
+            self.writer.add_message(
+                (
+                    None,
+                    channel.id,
+                    0,
+                    "system",
+                    f"Errore durante il backup del canale {channel.id} ({channel.name}): {error}",
+                    datetime.utcnow().isoformat(),
+                )
+            )
+        self.writer.flush()
+        return None
+
+    def finish(self):
+        self.writer.finish()
+        return self.db_path
+
+    def close(self):
+        self.writer.close()
+
+
+class ArchiveSink:
+    name = "archive"
+
+    def __init__(self, backup_dir, guild, mode, channel_names):
+        self.path = backup_dir / ARCHIVE_FILE
+        self.header = {
+            "guild_id": guild.id,
+            "created_at": datetime.utcnow().isoformat(),
+            "mode": mode,
+            "format": "ndjson+gzip",
+            "embeds_file": EmbedStore.file_name,
+            "version": 1,
+        }
+        self.channel_order = [channel.id for channel in guild.text_channels]
+        self.entries = {}
+        self.buffers = {}
+        self.buffered = {}
+        self.recovered = {}
+        if self.path.exists():
+            with open(self.path, "rb") as f:
+                blocks, end = scan_archive_blocks(f, os.path.getsize(self.path))
+            for channel_id, block in blocks:
+                self.recovered.setdefault(channel_id, []).append(block)
+            os.truncate(self.path, end)
+        self.file = open(self.path, "ab")
+
+    def channel_entry(self, channel, state):
+        last_message_id = (state.get("last_message_id") if state else None) or 0
+        last_block = sink_position(state, self.name)
+        recovered = self.recovered.pop(channel.id, [])
+        if last_block:
+            recovered = recovered[:next((index + 1 for index, block in enumerate(recovered) if block[:2] == last_block), len(recovered))]
+        blocks = []
+        for block in reversed(recovered):
+            if block[3] <= last_message_id and (not blocks or block[3] < blocks[-1][2]):
+                blocks.append(block)
+        blocks.reverse()
+        self.entries[channel.id] = {
+            "id": channel.id,
+            "name": channel.name,
+            "category_id": channel.category.id if channel.category else None,
+            "message_count": state["count"] if state else 0,
+            "blocks": blocks,
+        }
+
+    def skip_channel(self, channel, state):
+        self.channel_entry(channel, state)
+
+    def write_embeds(self, entries):
+        pass
+
+    def open_channel(self, channel, state):
+        self.channel_entry(channel, state)
+        self.buffers[channel.id] = []
+        self.buffered[channel.id] = 0
+
+    def write(self, channel, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        self.buffers[channel.id].append((record["id"], line))
+        self.buffered[channel.id] += len(line)
+        self.entries[channel.id]["message_count"] += 1
+        if self.buffered[channel.id] >= BACKUP_ARCHIVE_BLOCK_SIZE:
+            self.write_block(channel.id)
+
+    def write_block(self, channel_id):
+        lines = self.buffers[channel_id]
+        if not lines:
+            return
+        member = gzip_member("".join(line for _, line in lines).encode("utf-8"), b"BA", channel_id, lines[0][0], lines[-1][0], len(lines))
+        offset = self.file.tell()
+        self.file.write(member)
+        self.entries[channel_id]["blocks"].append([offset, len(member), lines[0][0], lines[-1][0], len(lines)])
+        self.buffers[channel_id] = []
+        self.buffered[channel_id] = 0
+
+    def checkpoint(self, channel):
+        self.write_block(channel.id)
+        self.file.flush()
+        blocks = self.entries[channel.id]["blocks"]
+        return blocks[-1][:2] if blocks else None
+
+    def close_channel(self, channel, count, error=None):
+        self.write_block(channel.id)
+        self.buffers.pop(channel.id)
+        self.buffered.pop(channel.id)
+        self.file.flush()
+        if error:
+            self.entries[channel.id]["error"] = error
+        return None
+
+    def finish(self):
+        index = dict(self.header)
+        index["channels"] = [self.entries[channel_id] for channel_id in self.channel_order if channel_id in self.entries]
+        index_offset = self.file.tell()
+        index_member = gzip_member(json.dumps(index, ensure_ascii=False).encode("utf-8"), b"BI")
+        self.file.write(index_member)
+        self.file.write(gzip_member(b"", b"BF", index_offset, len(index_member)))
+        self.file.flush()
+        return self.path
+
+    def close(self):
+        self.file.close()
+
+
+BACKUP_SINKS = {
+    "txt": TxtSink,
+    "json": JsonSink,
+    "db": DbSink,
+    "archive": ArchiveSink,
+}
+
+
+def sink_position(state, name):
+    if not state:
+        return None
+    return (state.get("positions") or {}).get(name)
+
+
+RATE_LIMIT_RETRY = re.compile(r"responded with 429\. Retrying in (\d+(?:\.\d+)?) seconds")
+RATE_LIMIT_CHANNEL = re.compile(r"/channels/(\d+)(?:/|\s|$)")
+RATE_LIMIT_GUILD = re.compile(r"/guilds/(\d+)/members")
+BACKUP_STATS = {}
+metrics_server = None
+
+
+class BackupStats:
+    def __init__(self, guild, backup_dir, channels):
+        self.guild_id = guild.id
+        self.guild_name = guild.name
+        self.backup_dir = backup_dir
+        self.started = time.monotonic()
+        self.finished = None
+        self.channels = {channel.id: self.new_channel(channel) for channel in channels}
+        self.rate_limit_wait = 0.0
+        self.downloader = None
+        self.extra_bytes = 0
+
+    @staticmethod
+    def new_channel(channel):
+        return {
+            "name": channel.name,
+            "messages": 0,
+            "bytes_written": 0,
+            "attachments": 0,
+            "attachment_bytes": 0,
+            "rate_limit_wait": 0.0,
+            "io_time": 0.0,
+            "started": None,
+            "finished": None,
+        }
+
+    def begin_channel(self, channel_id):
+        self.channels[channel_id]["started"] = time.monotonic()
+
+    def end_channel(self, channel_id, bytes_written):
+        channel = self.channels[channel_id]
+        channel["finished"] = time.monotonic()
+        channel["bytes_written"] += bytes_written
+
+    def add_message(self, channel_id, attachments):
+        channel = self.channels[channel_id]
+        channel["messages"] += 1
+        for att in attachments:
+            if att.get("saved_path"):
+                channel["attachments"] += 1
+                channel["attachment_bytes"] += att.get("size") or 0
+
+    def add_rate_limit_wait(self, channel_id, seconds):
+        if channel_id in self.channels:
+            self.channels[channel_id]["rate_limit_wait"] += seconds
+        else:
+            self.rate_limit_wait += seconds
+
+    @contextlib.contextmanager
+    def measure_io(self, channel_id):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.channels[channel_id]["io_time"] += time.perf_counter() - start
+
+    def finish(self, data_paths=None):
+        self.finished = time.monotonic()
+        for path in (data_paths or {}).values():
+            if path and Path(path).exists():
+                self.extra_bytes += Path(path).stat().st_size
+
+    @staticmethod
+    def rate(messages, start, end):
+        if start is None:
+            return 0.0
+        elapsed = (end or time.monotonic()) - start
+        return messages / elapsed if elapsed > 0 else 0.0
+
+    def snapshot(self):
+        channels = {}
+        for channel_id, channel in self.channels.items():
+            entry = {key: value for key, value in channel.items() if key not in ("started", "finished")}
+            entry["elapsed"] = round(((channel["finished"] or time.monotonic()) - channel["started"]), 3) if channel["started"] else 0.0
+            entry["messages_per_second"] = round(self.rate(channel["messages"], channel["started"], channel["finished"]), 2)
+            entry["rate_limit_wait"] = round(entry["rate_limit_wait"], 3)
+            entry["io_time"] = round(entry["io_time"], 3)
+            channels[str(channel_id)] = entry
+        messages = sum(channel["messages"] for channel in self.channels.values())
+        totals = {
+            "messages": messages,
+            "messages_per_second": round(self.rate(messages, self.started, self.finished), 2),
+            "bytes_written": sum(channel["bytes_written"] for channel in self.channels.values()) + self.extra_bytes,
+            "attachments": sum(channel["attachments"] for channel in self.channels.values()),
+            "attachment_bytes": sum(channel["attachment_bytes"] for channel in self.channels.values()),
+            "downloaded_bytes": self.downloader.downloaded_bytes if self.downloader else 0,
+            "rate_limit_wait": round(self.rate_limit_wait + sum(channel["rate_limit_wait"] for channel in self.channels.values()), 3),
+            "io_time": round(sum(channel["io_time"] for channel in self.channels.values()), 3),
+            "elapsed": round((self.finished or time.monotonic()) - self.started, 3),
+        }
+        return {
+            "guild_id": self.guild_id,
+            "guild_name": self.guild_name,
+            "running": self.finished is None,
+            "totals": totals,
+            "channels": channels,
+        }
+
+    def summary(self):
+        totals = self.snapshot()["totals"]
+        return (
+            f"{totals['messages']} messaggi • {totals['messages_per_second']:.0f} msg/s • "
+            f"{totals['attachments']} allegati • attesa rate limit {totals['rate_limit_wait']:.1f}s"
+        )
+
+    def write(self):
+        stats_path = self.backup_dir / "stats.json"
+        with open(stats_path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+        return stats_path
+
+
+class RateLimitLogHandler(logging.Handler):
+    def emit(self, record):
+        try:
+            message = record.getMessage()
+        except Exception:
+            return
+        match = RATE_LIMIT_RETRY.search(message)
+        if not match:
+            return
+        seconds = float(match.group(1))
+        channel_match = RATE_LIMIT_CHANNEL.search(message)
+        if channel_match:
+            channel_id = int(channel_match.group(1))
+            for stats in BACKUP_STATS.values():
+                if stats.finished is None and channel_id in stats.channels:
+                    stats.add_rate_limit_wait(channel_id, seconds)
+                    return
+            return
+        guild_match = RATE_LIMIT_GUILD.search(message)
+        stats = BACKUP_STATS.get(int(guild_match.group(1))) if guild_match else None
+        if stats is not None and stats.finished is None:
+            stats.add_rate_limit_wait(None, seconds)
+
+
+logging.getLogger("discord.http").addHandler(RateLimitLogHandler())
+
+
+def prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus_metrics():
+    metrics = (
+        ("messages", "discord_backup_messages_total", "counter", "Messages saved"),
+        ("bytes_written", "discord_backup_bytes_written_total", "counter", "Bytes written to backup files"),
+        ("attachments", "discord_backup_attachments_total", "counter", "Attachments saved"),
+        ("attachment_bytes", "discord_backup_attachment_bytes_total", "counter", "Attachment bytes saved"),
+        ("rate_limit_wait", "discord_backup_rate_limit_wait_seconds_total", "counter", "Seconds spent waiting on rate limits"),
+        ("io_time", "discord_backup_io_seconds_total", "counter", "Seconds spent writing backup files"),
+        ("messages_per_second", "discord_backup_messages_per_second", "gauge", "Message throughput"),
+    )
+    snapshots = [stats.snapshot() for stats in BACKUP_STATS.values()]
+    lines = [
+        "# HELP discord_backup_running Whether a backup is in progress",
+        "# TYPE discord_backup_running gauge",
+    ]
+    for snapshot in snapshots:
+        lines.append(f'discord_backup_running{{guild="{prometheus_label(snapshot["guild_name"])}"}} {int(snapshot["running"])}')
+    for key, name, kind, description in metrics:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for snapshot in snapshots:
+            guild = prometheus_label(snapshot["guild_name"])
+            lines.append(f'{name}{{guild="{guild}"}} {snapshot["totals"][key]}')
+            for channel in snapshot["channels"].values():
+                lines.append(f'{name}{{guild="{guild}",channel="{prometheus_label(channel["name"])}"}} {channel[key]}')
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1] == b"/metrics":
+            status = "200 OK"
+            body = render_prometheus_metrics().encode("utf-8")
+        else:
+            status = "404 Not Found"
+            body = b"Not Found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii")
+            + body
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+
+async def ensure_metrics_server():
+    global metrics_server
+    if not BACKUP_METRICS_PORT or metrics_server is not None:
+        return
+    try:
+        metrics_server = await asyncio.start_server(handle_metrics_request, BACKUP_METRICS_HOST, BACKUP_METRICS_PORT)
+    except OSError:
+        metrics_server = None
+
+
+USER_MENTION = re.compile(r"<@!?(\d+)>")
+ROLE_MENTION = re.compile(r"<@&(\d+)>")
+CHANNEL_MENTION = re.compile(r"<#(\d+)>")
+MASS_MENTION = re.compile(r"@(everyone|here)")
+
+
+class MentionTable:
+    file_name = "mentions.json"
+
+    def __init__(self, guild, backup_dir):
+        self.path = backup_dir / self.file_name
+        self.users = {}
+        if self.path.exists():
+            try:
+                self.users = read_json_file(self.path).get("users", {})
+            except Exception:
+                self.users = {}
+        self.roles = {str(role.id): role.name for role in guild.roles}
+        self.channels = {str(channel.id): channel.name for channel in guild.channels}
+
+    def add_user(self, user):
+        key = str(user.id)
+        if key not in self.users:
+            self.users[key] = user.display_name
+
+    def add_message(self, msg):
+        self.add_user(msg.author)
+        for user in msg.mentions:
+            self.add_user(user)
+
+    def snapshot(self):
+        return {"users": dict(self.users), "roles": self.roles, "channels": self.channels}
+
+    def write(self, snapshot):
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+
+
+def embed_memo_key(embed):
+    slots = getattr(type(embed), "__slots__", None)
+    if not slots:
+        return repr(embed.to_dict())
+    return repr([getattr(embed, slot, None) for slot in slots])
+
+
+class EmbedStore:
+    file_name = "embeds.ndjson"
+    index_name = "embeds_index.db"
+    memo_size = 4096
+
+    def __init__(self, backup_dir):
+        self.path = backup_dir / self.file_name
+        self.index_path = backup_dir / self.index_name
+        self.known = set()
+        self.memo = collections.OrderedDict()
+        self.pending = []
+        self.file = None
+        self.index = None
+
+    def intern(self, embed):
+        key = embed_memo_key(embed)
+        embed_hash = self.memo.get(key)
+        if embed_hash is not None:
+            self.memo.move_to_end(key)
+            return embed_hash
+        payload = json.dumps(embed.to_dict(), ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        embed_hash = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:20]
+        self.memo[key] = embed_hash
+        if len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+        if embed_hash not in self.known:
+            self.known.add(embed_hash)
+            self.pending.append((embed_hash, payload))
+        return embed_hash
+
+    def intern_records(self, records):
+        for record in records:
+            record["embeds"] = [self.intern(embed) for embed in record["embeds"]]
+        entries = self.pending
+        self.pending = []
+        if entries:
+            if self.file is None:
+                self.file = open(self.path, "ab")
+                self.index = sqlite3.connect(self.index_path)
+                self.index.execute("CREATE TABLE IF NOT EXISTS embeds (hash TEXT PRIMARY KEY, offset INTEGER, length INTEGER)")
+            offset = self.file.tell()
+            rows = []
+            lines = []
+            for embed_hash, payload in entries:
+                line = f'{{"id":"{embed_hash}","embed":{payload}}}\n'.encode("utf-8")
+                rows.append((embed_hash, offset, len(line)))
+                lines.append(line)
+                offset += len(line)
+            self.file.write(b"".join(lines))
+            self.file.flush()
+            with self.index:
+                self.index.executemany("INSERT OR IGNORE INTO embeds (hash, offset, length) VALUES (?, ?, ?)", rows)
+        return entries
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.index.close()
+            self.file = None
+            self.index = None
+
+
+def load_mention_table(chain):
+    table = {"users": {}, "roles": {}, "channels": {}}
+    for link_dir, link_meta in chain:
+        mentions_path = link_dir / (link_meta.get("mentions_file") or MentionTable.file_name)
+        if not mentions_path.exists():
+            continue
+        try:
+            data = read_json_file(mentions_path)
+        except Exception:
+            continue
+        for key in table:
+            table[key].update(data.get(key) or {})
+    return table
+
+
+def resolve_mentions(content, table):
+    if not content:
+        return ""
+    if table:
+        content = USER_MENTION.sub(lambda m: f"@{table['users'].get(m.group(1), 'deleted-user')}", content)
+        content = ROLE_MENTION.sub(lambda m: f"@{table['roles'].get(m.group(1), 'deleted-role')}", content)
+        content = CHANNEL_MENTION.sub(lambda m: f"#{table['channels'].get(m.group(1), 'deleted-channel')}", content)
+    return MASS_MENTION.sub("@\u200b\\1", content)
+
+
+def message_record(msg):
+    return {
+        "id": msg.id,
+        "author_id": msg.author.id,
+        "author_tag": str(msg.author),
+        "content": (msg.clean_content if BACKUP_CLEAN_CONTENT else msg.content) or "",
+        "created_at": msg.created_at.isoformat(),
+        "embeds": list(msg.embeds),
+        "attachments": [],
+    }
+
+
+async def backup_messages(guild, backup_dir, methods, mode, progress_msg, after_ids=None, high_water=None, journal=None):
+    if high_water is None:
+        high_water = {}
+    text_channels = guild.text_channels
+    channel_names = unique_channel_names(text_channels)
+    media_dir = backup_dir / "media"
+    media_dir.mkdir(exist_ok=True)
+    sinks = []
+    stats = BackupStats(guild, backup_dir, text_channels)
+    mentions = MentionTable(guild, backup_dir)
+    embeds = EmbedStore(backup_dir)
+    io = BackgroundWriter()
+    failed_channels = set()
+
+    def open_sinks():
+        for method in methods:
+            sinks.append(BACKUP_SINKS[method](backup_dir, guild, mode, channel_names))
+
+    def channel_io(fn, channel, *args):
+        if channel.id in failed_channels:
+            return
+        try:
+            fn(channel, *args)
+        except Exception:
+            failed_channels.add(channel.id)
+            raise
+
+    def skip_channel(channel, state):
+        for sink in sinks:
+            sink.skip_channel(channel, state)
+
+    def open_channel(channel, state):
+        with stats.measure_io(channel.id):
+            for sink in sinks:
+                sink.open_channel(channel, state)
+
+    def write_records(channel, records, checkpoint=None, mentions_snapshot=None):
+        with stats.measure_io(channel.id):
+            new_embeds = embeds.intern_records(records)
+            if new_embeds:
+                for sink in sinks:
+                    sink.write_embeds(new_embeds)
+            for record in records:
+                for sink in sinks:
+                    sink.write(channel, record)
+            if checkpoint is None:
+                return
+            positions = {sink.name: sink.checkpoint(channel) for sink in sinks}
+            mentions.write(mentions_snapshot)
+        if journal:
+            journal.checkpoint(channel.id, checkpoint[0], checkpoint[1], positions)
+
+    def close_channel(channel, state, count, last_message_id, error):
+        with stats.measure_io(channel.id):
+            positions = {sink.name: sink.close_channel(channel, count, error) for sink in sinks}
+        stats.end_channel(
+            channel.id,
+            sum(position - (sink_position(state, name) or 0) for name, position in positions.items() if position is not None),
+        )
+        if journal and error is None:
+            journal.checkpoint(channel.id, last_message_id, count, positions, done=True)
+
+    def finish_sinks(mentions_snapshot):
+        mentions.write(mentions_snapshot)
+        return {sink.name: sink.finish() for sink in sinks}
+
+    def close_sinks():
+        embeds.close()
+        for sink in sinks:
+            sink.close()
+
+    async def backup_channel(channel):
+        channel_media_dir = media_dir / channel_names[channel.id]
+        channel_media_dir.mkdir(exist_ok=True)
+        state = journal.channel_state(channel.id) if journal else None
+        if state and state.get("done"):
+            io.submit(skip_channel, channel, state, key=channel.id)
+            error = await io.wait(channel.id)
+            if error is not None:
+                raise error
+            return
+        count = state["count"] if state else 0
+        stats.begin_channel(channel.id)
+        io.submit(channel_io, open_channel, channel, state, key=channel.id)
+        batch = []
+        error = None
+
+        def write(record, attachments):
+            nonlocal count, batch
+            record["attachments"] = attachments
+            batch.append(record)
+            stats.add_message(channel.id, attachments)
+            high_water[str(channel.id)] = record["id"]
+            count += 1
+            if journal and count % BACKUP_CHECKPOINT_INTERVAL == 0:
+                io.submit(channel_io, write_records, channel, batch, (record["id"], count), mentions.snapshot(), key=channel.id)
+                batch = []
+            elif len(batch) >= BACKUP_WRITE_BATCH:
+                io.submit(channel_io, write_records, channel, batch, key=channel.id)
+                batch = []
+
+        try:
+            history_kwargs = channel_history_kwargs(channel, mode, after_ids)
+            ordered = OrderedMessageWriter(write)
+            try:
+                async for msg in channel.history(**history_kwargs):
+                    mentions.add_message(msg)
+                    await ordered.add(message_record(msg), await submit_attachments(downloader, channel_media_dir, msg))
+                    await io.throttle()
+                    if channel.id in failed_channels:
+                        break
+            finally:
+                await ordered.close()
+        except Exception as e:
+            error = str(e)
+        if batch:
+            io.submit(channel_io, write_records, channel, batch, key=channel.id)
+        write_error = await io.wait(channel.id)
+        if write_error is not None:
+            error = f"Errore di scrittura: {write_error}"
+        await io.run(close_channel, channel, state, count, high_water.get(str(channel.id)), error)
+
+    downloader = None
+    data_paths = None
+    BACKUP_STATS[guild.id] = stats
+    await ensure_metrics_server()
+    try:
+        await io.run(open_sinks)
+        if mode == "full":
+            downloader = AttachmentDownloader(backup_dir)
+            stats.downloader = downloader
+        label = "+".join(method.upper() for method in methods)
+        await run_channel_pool(text_channels, backup_channel, progress_msg, label, status=stats.summary)
+        if failed_channels:
+            raise RuntimeError(
+                f"Errore di scrittura su disco ({len(failed_channels)} canali): riprendi il backup con `!backup resume {backup_dir.name}`"
+            )
+        data_paths = await io.run(finish_sinks, mentions.snapshot())
+        return data_paths
+    finally:
+        try:
+            await io.run(close_sinks)
+        finally:
+            await io.close()
+        if downloader:
+            await downloader.close()
+        stats.finish(data_paths)
+        try:
+            stats.write()
+        except OSError:
+            pass
+
+
+async def backup_messages_txt(guild, backup_dir, mode, progress_msg, after_ids=None, high_water=None, journal=None):
+    await backup_messages(guild, backup_dir, ["txt"], mode, progress_msg, after_ids, high_water, journal)
+
+
+async def backup_messages_json(guild, backup_dir, mode, progress_msg, after_ids=None, high_water=None, journal=None):
+    data_paths = await backup_messages(guild, backup_dir, ["json"], mode, progress_msg, after_ids, high_water, journal)
+    return data_paths["json"]
+
+
+async def backup_messages_db(guild, backup_dir, mode, progress_msg, after_ids=None, high_water=None, journal=None):
+    data_paths = await backup_messages(guild, backup_dir, ["db"], mode, progress_msg, after_ids, high_water, journal)
+    return data_paths["db"]
+
+
+class BackupManifest:
+    file_name = "manifest.json"
+    cache_name = "verify_cache.json"
+    volatile_files = (file_name, cache_name, CheckpointJournal.file_name, "stats.json", SEARCH_INDEX_FILE)
+
+    def __init__(self, backup_dir, file_name=None):
+        self.backup_dir = backup_dir
+        self.path = backup_dir / (file_name or self.file_name)
+        self.cache_path = backup_dir / self.cache_name
+        self.done = 0
+        self.total = 0
+        self.hashed = 0
+
+    def exists(self):
+        return self.path.exists()
+
+    def tracked_files(self):
+        for root, dirs, files in os.walk(self.backup_dir):
+            dirs[:] = sorted(name for name in dirs if not name.endswith(".tmp"))
+            for name in sorted(files):
+                path = Path(root) / name
+                relative = path.relative_to(self.backup_dir).as_posix()
+                if name.endswith(".tmp") or ("/" not in relative and (name in self.volatile_files or is_metadata_file(path))):
+                    continue
+                yield relative, path
+
+    def load_cache(self):
+        try:
+            return read_json_file(self.cache_path)
+        except (OSError, ValueError):
+            return {}
+
+    def write_json(self, path, data):
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def hash_files(self, entries, cache, use_cache=True):
+        digests = {}
+        pending = []
+        for relative, path, st in entries:
+            cached = cache.get(relative)
+            if use_cache and isinstance(cached, list) and len(cached) == 3 and cached[:2] == [st.st_size, st.st_mtime_ns]:
+                digests[relative] = cached[2]
+                self.done += 1
+            else:
+                pending.append((relative, path, st))
+        self.hashed = len(pending)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=BACKUP_VERIFY_WORKERS) as pool:
+            futures = {pool.submit(hash_file, path): (relative, st) for relative, path, st in pending}
+            for future in concurrent.futures.as_completed(futures):
+                relative, st = futures[future]
+                try:
+                    digests[relative] = future.result()
+                    cache[relative] = [st.st_size, st.st_mtime_ns, digests[relative]]
+                except OSError:
+                    digests[relative] = None
+                self.done += 1
+        return digests
+
+    def store_digests(self, entries, cache):
+        digests = {}
+        linked = [
+            (relative, path, st)
+            for relative, path, st in entries
+            if relative.startswith("media/") and st.st_nlink > 1 and path.name.split("_", 1)[0].isdigit()
+        ]
+        if not linked:
+            return digests
+        store = MediaStore()
+        try:
+            for relative, path, st in linked:
+                sha256 = store.linked_digest(int(path.name.split("_", 1)[0]), st)
+                if sha256:
+                    digests[relative] = sha256
+                    cache[relative] = [st.st_size, st.st_mtime_ns, sha256]
+        finally:
+            store.close()
+        self.done += len(digests)
+        return digests
+
+    def build(self):
+        entries = [(relative, path, path.stat()) for relative, path in self.tracked_files()]
+        self.total = len(entries)
+        cache = {}
+        digests = self.store_digests(entries, cache)
+        digests.update(self.hash_files([entry for entry in entries if entry[0] not in digests], cache, use_cache=False))
+        files = {relative: {"size": st.st_size, "sha256": digests[relative]} for relative, _, st in entries}
+        self.write_json(self.path, {"version": 1, "algorithm": "sha256", "files": files})
+        self.write_json(self.cache_path, cache)
+        return self.path
+
+    def verify(self, full=False):
+        try:
+            files = read_json_file(self.path)["files"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return {"error": f"{self.path.name} illeggibile"}
+        self.total = len(files)
+        cache = self.load_cache()
+        missing = []
+        changed = []
+        entries = []
+        for relative, expected in files.items():
+            path = self.backup_dir / relative
+            try:
+                st = path.stat()
+            except OSError:
+                missing.append(relative)
+                self.done += 1
+                continue
+            if st.st_size != expected.get("size"):
+                changed.append(relative)
+                self.done += 1
+                continue
+            entries.append((relative, path, st))
+        digests = self.hash_files(entries, cache, use_cache=not full)
+        changed.extend(relative for relative, _, _ in entries if digests.get(relative) != files[relative].get("sha256"))
+        with contextlib.suppress(OSError):
+            self.write_json(self.cache_path, cache)
+        return {
+            "files": len(files),
+            "bytes": sum(expected.get("size") or 0 for expected in files.values()),
+            "hashed": self.hashed,
+            "missing": missing,
+            "changed": sorted(changed),
+        }
+
+
+async def verify_backup_chain(chain, progress_msg, full=False):
+    results = []
+    for link_dir, link_meta in chain:
+        manifest = BackupManifest(link_dir, link_meta.get("manifest_file"))
+        if not manifest.exists():
+            results.append((link_dir, None))
+            continue
+        task = asyncio.create_task(asyncio.to_thread(manifest.verify, full))
+        while not task.done():
+            bar = generate_progress_bar(manifest.done, manifest.total)
+            await safe_edit(progress_msg, content=f"🔐 Verifica di {link_dir.name}: {bar}")
+            await asyncio.wait({task}, timeout=2)
+        results.append((link_dir, task.result()))
+    return results
+
+
+def verification_problems(results, limit=10):
+    problems = []
+    for link_dir, result in results:
+        if result is None:
+            continue
+        if "error" in result:
+            problems.append(f"{link_dir.name}: {result['error']}")
+            continue
+        for label, names in (("mancante", result["missing"]), ("modificato", result["changed"])):
+            problems.extend(f"{link_dir.name}/{name}: {label}" for name in names)
+    if len(problems) > limit:
+        problems = problems[:limit] + [f"... e altri {len(problems) - limit} problemi"]
+    return problems
+
+
+async def export_member_list(guild, backup_dir):
+    members_path = backup_dir / MEMBER_LIST_FILE
+    try:
+        with open(members_path, "w", encoding="utf-8") as f:
+            async for member in guild.fetch_members(limit=None):
+                name = str(member).replace("|", "/").replace("\n", " ")
+                roles = ", ".join(role.name for role in member.roles if not role.is_default()) or "None"
+                joined_at = member.joined_at.isoformat() if member.joined_at else "-"
+                f.write(f"Username: {name} | ID: {member.id}\nJoined: {joined_at}\nRoles: {roles}\n---\n")
+    except Exception:
+        logging.getLogger(__name__).exception("Esportazione dei membri di %s non riuscita", guild.id)
+        members_path.unlink(missing_ok=True)
+        return None
+    return members_path
+
+
+async def create_metadata_file(backup_dir, guild, methods, mode, structure_path, data_paths, high_water=None, parent_path=None, members_path=None):
+    timestamp = datetime.utcnow().isoformat()
+    data_files = {method: str(path.name) for method, path in (data_paths or {}).items() if path}
+    data_file = data_files.get("json") or next(iter(data_files.values()), None)
+    meta = {
+        "guild_id": guild.id,
+        "guild_name": guild.name,
+        "created_at": timestamp,
+        "method": ",".join(methods),
+        "methods": methods,
+        "mode": mode,
+        "structure_file": str(structure_path.name),
+        "mentions_file": MentionTable.file_name if (backup_dir / MentionTable.file_name).exists() else None,
+        "members_file": members_path.name if members_path else None,
+        "embeds_file": EmbedStore.file_name if (backup_dir / EmbedStore.file_name).exists() else None,
+        "content_format": "clean" if BACKUP_CLEAN_CONTENT else "raw",
+        "data_file": data_file,
+        "data_files": data_files,
+        "channels_last_message_id": high_water or {},
+        "incremental": parent_path is not None,
+        "parent": Path(os.path.relpath(parent_path, backup_dir)).as_posix() if parent_path else None,
+        "version": 1,
+    }
+    viewer_index = await asyncio.to_thread(write_viewer_bundle, backup_dir, meta) if VIEWER_BUNDLE else None
+    meta["viewer_index"] = viewer_index.relative_to(backup_dir).as_posix() if viewer_index else None
+    manifest_path = await asyncio.to_thread(BackupManifest(backup_dir).build)
+    meta["manifest_file"] = manifest_path.name
+    safe_name = sanitize_name(guild.name) or str(guild.id)
+    file_name = f"backup_{safe_name}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.json"
+    meta_path = backup_dir / file_name
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta_path
+
+
+class CronSchedule:
+    ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("L'espressione cron deve avere 5 campi: minuto ora giorno mese giorno_settimana")
+        self.expression = " ".join(fields)
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+        try:
+            self.minutes, self.hours, self.days, self.months, weekdays = (
+                self.parse_field(field, low, high) for field, (low, high) in zip(fields, self.ranges)
+            )
+        except ValueError as e:
+            raise ValueError(f"Espressione cron non valida: {e}") from None
+        self.weekdays = {day % 7 for day in weekdays}
+
+    @staticmethod
+    def parse_field(field, low, high):
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step_text = part.split("/", 1)
+                step = int(step_text)
+                if step < 1:
+                    raise ValueError(f"passo non valido in {field}")
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = (int(value) for value in part.split("-", 1))
+            else:
+                start = int(part)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end:
+                raise ValueError(f"{field} fuori intervallo ({low}-{high})")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def matches(self, when):
+        if when.minute not in self.minutes or when.hour not in self.hours or when.month not in self.months:
+            return False
+        day_match = when.day in self.days
+        weekday_match = (when.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_match and weekday_match
+        return day_match or weekday_match
+
+
+class BackupJobQueue:
+    schema = (
+        "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, guild_id INTEGER, channel_id INTEGER, "
+        "methods TEXT, mode TEXT, incremental INTEGER, priority INTEGER, status TEXT, backup_dir TEXT, "
+        "requested_by TEXT, schedule_id INTEGER, created_at TEXT, started_at TEXT, finished_at TEXT, error TEXT, "
+        "members INTEGER DEFAULT 0)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, priority, id)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_guild ON jobs (guild_id, id)",
+        "CREATE TABLE IF NOT EXISTS schedules (id INTEGER PRIMARY KEY AUTOINCREMENT, guild_id INTEGER, channel_id INTEGER, "
+        "cron TEXT, methods TEXT, mode TEXT, incremental INTEGER, priority INTEGER, last_run TEXT, created_by TEXT, "
+        "members INTEGER DEFAULT 0)",
+    )
+    added_columns = (("jobs", "members INTEGER DEFAULT 0"), ("schedules", "members INTEGER DEFAULT 0"))
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.running = {}
+        self.cancel_requested = set()
+        self.wakeup = None
+        self.tasks = []
+
+    def start(self):
+        if self.conn is not None:
+            return
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            for statement in self.schema:
+                self.conn.execute(statement)
+            for table, column in self.added_columns:
+                columns = {row["name"] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+                if column.split()[0] not in columns:
+                    self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+            self.conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.dispatch_loop()), asyncio.create_task(self.schedule_loop())]
+        for task in self.tasks:
+            task.add_done_callback(self.loop_done)
+
+    @staticmethod
+    def loop_done(task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.getLogger(__name__).error(
+                "Ciclo della coda dei backup terminato: %s", task.get_coro().__qualname__, exc_info=task.exception()
+            )
+
+    async def stop(self):
+        tasks = self.tasks + [task for _, task in self.running.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks = []
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def enqueue(self, guild_id, channel_id, methods, mode, incremental=False, priority=10, requested_by=None, schedule_id=None, backup_dir=None, members=False):
+        self.start()
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO jobs (guild_id, channel_id, methods, mode, incremental, priority, status, backup_dir, "
+                "requested_by, schedule_id, created_at, members) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?, ?)",
+                (
+                    guild_id,
+                    channel_id,
+                    ",".join(methods),
+                    mode,
+                    int(bool(incremental)),
+                    priority,
+                    str(backup_dir) if backup_dir else None,
+                    requested_by,
+                    schedule_id,
+                    datetime.utcnow().isoformat(),
+                    int(bool(members)),
+                ),
+            )
+        self.dispatch()
+        return cursor.lastrowid
+
+    def update(self, job_id, **fields):
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self.conn:
+            self.conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        self.start()
+        return self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def queued(self):
+        return self.conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY priority DESC, id").fetchall()
+
+    def position(self, job_id):
+        for index, job in enumerate(self.queued(), start=1):
+            if job["id"] == job_id:
+                return index
+        return None
+
+    def guild_jobs(self, guild_id, limit=10):
+        self.start()
+        return self.conn.execute(
+            "SELECT * FROM jobs WHERE guild_id = ? ORDER BY CASE status WHEN 'running' THEN 0 WHEN 'queued' THEN 1 ELSE 2 END, "
+            "CASE WHEN status = 'queued' THEN priority ELSE 0 END DESC, id DESC LIMIT ?",
+            (guild_id, limit),
+        ).fetchall()
+
+    def cancel(self, job_id, guild_id):
+        job = self.get(job_id)
+        if job is None or job["guild_id"] != guild_id:
+            return None
+        if job["status"] == "queued":
+            self.update(job_id, status="cancelled", finished_at=datetime.utcnow().isoformat())
+        elif job["status"] == "running" and job_id in self.running:
+            self.cancel_requested.add(job_id)
+            self.running[job_id][1].cancel()
+        return job["status"]
+
+    def dispatch(self):
+        if self.conn is None:
+            return
+        per_guild = collections.Counter(guild_id for guild_id, _ in self.running.values())
+        for job in self.queued():
+            if len(self.running) >= BACKUP_MAX_JOBS:
+                break
+            if per_guild[job["guild_id"]] >= BACKUP_MAX_JOBS_PER_GUILD:
+                continue
+            self.update(job["id"], status="running", started_at=datetime.utcnow().isoformat())
+            task = asyncio.create_task(self.run_job(job))
+            self.running[job["id"]] = (job["guild_id"], task)
+            per_guild[job["guild_id"]] += 1
+
+    async def dispatch_loop(self):
+        while True:
+            self.wakeup.clear()
+            self.dispatch()
+            await self.wakeup.wait()
+
+    async def run_job(self, job):
+        error = None
+        try:
+            await run_backup_job(self, job)
+            status = "done"
+        except asyncio.CancelledError:
+            if job["id"] not in self.cancel_requested:
+                # Bot shutdown: leave the job "running" so start() requeues and resumes it.
+                self.running.pop(job["id"], None)
+                raise
+            status = "cancelled"
+        except Exception as e:
+            status = "failed"
+            error = str(e) or type(e).__name__
+        self.running.pop(job["id"], None)
+        self.cancel_requested.discard(job["id"])
+        self.update(job["id"], status=status, error=error, finished_at=datetime.utcnow().isoformat())
+        self.wakeup.set()
+        if status != "done":
+            await notify_job_end(job, status, error)
+
+    def add_schedule(self, guild_id, channel_id, cron, methods, mode, incremental, priority, created_by, members=False):
+        self.start()
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO schedules (guild_id, channel_id, cron, methods, mode, incremental, priority, created_by, members) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (guild_id, channel_id, cron, ",".join(methods), mode, int(bool(incremental)), priority, created_by, int(bool(members))),
+            )
+        return cursor.lastrowid
+
+    def schedules(self, guild_id=None):
+        self.start()
+        if guild_id is None:
+            return self.conn.execute("SELECT * FROM schedules ORDER BY id").fetchall()
+        return self.conn.execute("SELECT * FROM schedules WHERE guild_id = ? ORDER BY id", (guild_id,)).fetchall()
+
+    def remove_schedule(self, schedule_id, guild_id):
+        self.start()
+        with self.conn:
+            return self.conn.execute("DELETE FROM schedules WHERE id = ? AND guild_id = ?", (schedule_id, guild_id)).rowcount
+
+    def run_schedules(self, now):
+        minute = now.strftime("%Y-%m-%d %H:%M")
+        for schedule in self.schedules():
+            if schedule["last_run"] == minute or not CronSchedule(schedule["cron"]).matches(now):
+                continue
+            with self.conn:
+                self.conn.execute("UPDATE schedules SET last_run = ? WHERE id = ?", (minute, schedule["id"]))
+            pending = self.conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE schedule_id = ? AND status IN ('queued', 'running')",
+                (schedule["id"],),
+            ).fetchone()[0]
+            if pending:
+                continue
+            self.enqueue(
+                schedule["guild_id"],
+                schedule["channel_id"],
+                schedule["methods"].split(","),
+                schedule["mode"],
+                schedule["incremental"],
+                schedule["priority"],
+                requested_by="scheduler",
+                schedule_id=schedule["id"],
+                members=schedule["members"],
+            )
+
+    async def schedule_loop(self):
+        while True:
+            now = datetime.now()
+            try:
+                self.run_schedules(now)
+            except Exception:
+                logging.getLogger(__name__).exception("Errore durante l'avvio dei backup pianificati")
+            await asyncio.sleep(60 - now.second)
+
+
+job_queue = BackupJobQueue(BACKUP_JOBS_DB)
+
+
+def create_backup_dir(guild):
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
     safe_name = sanitize_name(guild.name) or str(guild.id)
-    file_name = f"backup_{safe_name}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.json"
-    meta_path = backup_dir / file_name
-    with open(meta_path, "w", encoding="utf-8") as f:
-        json.dump(meta, f, ensure_ascii=False, indent=2)
-    return meta_path
+    backup_dir = Path(f"backup_{safe_name}_{timestamp}")
+    suffix = 1
+    while backup_dir.exists():
+        suffix += 1
+        backup_dir = Path(f"backup_{safe_name}_{timestamp}_{suffix}")
+    backup_dir.mkdir()
+    return backup_dir
+
+
+async def run_backup_job(queue, job):
+    guild = bot.get_guild(job["guild_id"])
+    destination = bot.get_channel(job["channel_id"])
+    if guild is None or destination is None:
+        raise RuntimeError("Server o canale di notifica non più disponibile")
+    backup_dir = Path(job["backup_dir"]) if job["backup_dir"] else None
+    if backup_dir is not None and (backup_dir / CheckpointJournal.file_name).exists():
+        journal = CheckpointJournal(backup_dir)
+        if journal.complete:
+            return
+        done = sum(1 for state in journal.channels.values() if state.get("done"))
+        await destination.send(f"🔁 Ripresa del backup {backup_dir.name}: {done} canali già completati.")
+    else:
+        methods = job["methods"].split(",")
+        parent = None
+        if job["incremental"]:
+            parent = find_latest_backup(guild.id, methods)
+            if parent is None:
+                await destination.send("ℹ️ Nessun backup precedente trovato con questo metodo, eseguo un backup completo.")
+        backup_dir = create_backup_dir(guild)
+        queue.update(job["id"], backup_dir=str(backup_dir))
+        journal = CheckpointJournal(backup_dir)
+        journal.start(
+            guild_id=guild.id,
+            methods=methods,
+            mode=job["mode"],
+            parent=str(parent[0].resolve()) if parent else None,
+            after_ids=parent[1]["channels_last_message_id"] if parent else {},
+            members=bool(job["members"]),
+        )
+    await run_backup(destination, guild, backup_dir, journal)
+
+
+async def notify_job_end(job, status, error):
+    destination = bot.get_channel(job["channel_id"])
+    if destination is None:
+        return
+    if status == "cancelled":
+        content = f"🚫 Backup #{job['id']} annullato."
+    else:
+        content = f"❌ Backup #{job['id']} fallito: {error}"
+    with contextlib.suppress(discord.HTTPException):
+        await destination.send(content)
+
+
+async def announce_job(ctx, job_id):
+    if job_id in job_queue.running:
+        return
+    await ctx.send(f"🕒 Backup #{job_id} in coda (posizione {job_queue.position(job_id)}). Usa `!backupstatus` per seguirlo.")
+
+
+@bot.event
+async def on_ready():
+    job_queue.start()
 
 
 @bot.command()
 @commands.has_permissions(administrator=True)
-async def backup(ctx, metodo: str = None, tipo: str = None):
+async def backup(ctx, metodo: str = None, tipo: str = None, *opzioni: str):
     guild = ctx.guild
-    method, mode = default_backup_options(metodo, tipo)
-    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    safe_name = sanitize_name(guild.name) or str(guild.id)
-    backup_dir = Path(f"backup_{safe_name}_{timestamp}")
-    backup_dir.mkdir(exist_ok=True)
-    description = f"Metodo: {method.upper()} • Modalità: {mode.upper()}"
+    if (metodo or "").lower() == "resume":
+        await resume_backup(ctx, tipo)
+        return
+    methods, mode = default_backup_options(metodo, tipo)
+    options = {option.lower() for option in opzioni}
+    incremental = bool(options & {"incrementale", "incremental"})
+    members = bool(options & {"membri", "members"})
+    job_id = job_queue.enqueue(guild.id, ctx.channel.id, methods, mode, incremental, requested_by=str(ctx.author), members=members)
+    await announce_job(ctx, job_id)
+
+
+async def resume_backup(ctx, cartella):
+    guild = ctx.guild
+    if not cartella:
+        await ctx.send("❌ Specifica la cartella del backup da riprendere: `!backup resume <cartella>`")
+        return
+    backup_dir = Path(cartella)
+    if not backup_dir.is_dir():
+        backup_dir = backup_dir.parent
+    journal = CheckpointJournal(backup_dir)
+    if journal.job is None:
+        await ctx.send(f"❌ Nessun journal di checkpoint trovato in {backup_dir.name}.")
+        return
+    if str(journal.job.get("guild_id")) != str(guild.id):
+        await ctx.send("❌ Questo backup appartiene a un altro server.")
+        return
+    if journal.complete:
+        await ctx.send(f"ℹ️ Il backup {backup_dir.name} è già completo.")
+        return
+    job_id = job_queue.enqueue(
+        guild.id,
+        ctx.channel.id,
+        journal.job["methods"],
+        journal.job["mode"],
+        requested_by=str(ctx.author),
+        backup_dir=backup_dir,
+    )
+    await announce_job(ctx, job_id)
+
+
+async def run_backup(ctx, guild, backup_dir, journal):
+    methods = journal.job["methods"]
+    mode = journal.job["mode"]
+    parent_path = Path(journal.job["parent"]) if journal.job.get("parent") else None
+    method_label = ", ".join(method.upper() for method in methods)
+    description = f"Metodo: {method_label} • Modalità: {mode.upper()}"
+    if parent_path:
+        description += f" • Incrementale da {parent_path.parent.name}"
     progress_msg = await ctx.send(f"📦 Avvio backup di **{guild.name}**\n{description}")
     structure_path = await backup_guild_structure(guild, backup_dir)
     await progress_msg.edit(content=f"📁 Struttura server salvata\n{description}")
-    data_path = None
-    if method == "txt":
-        await backup_messages_txt(guild, backup_dir, mode, progress_msg)
-    elif method == "json":
-        data_path = await backup_messages_json(guild, backup_dir, mode, progress_msg)
-    elif method == "db":
-        data_path = await backup_messages_db(guild, backup_dir, mode, progress_msg)
-    meta_path = await create_metadata_file(backup_dir, guild, method, mode, structure_path, data_path)
+    after_ids = journal.resume_after_ids(journal.job.get("after_ids"))
+    high_water = dict(after_ids)
+    members_task = asyncio.create_task(export_member_list(guild, backup_dir)) if journal.job.get("members") else None
+    try:
+        data_paths = await backup_messages(guild, backup_dir, methods, mode, progress_msg, after_ids, high_water, journal)
+        members_path = await members_task if members_task else None
+        meta_path = await create_metadata_file(
+            backup_dir,
+            guild,
+            methods,
+            mode,
+            structure_path,
+            data_paths,
+            high_water,
+            parent_path,
+            members_path,
+        )
+        journal.finish()
+    finally:
+        if members_task:
+            members_task.cancel()
+        journal.close()
     from discord import Embed
     embed = Embed(
         title="✅ Backup completato",
         description="Il backup del server è stato completato con successo.",
         color=discord.Color.green(),
     )
-    embed.add_field(name="Metodo", value=method.upper(), inline=True)
+    embed.add_field(name="Metodo", value=method_label, inline=True)
     embed.add_field(name="Modalità", value=mode.upper(), inline=True)
+    if parent_path:
+        embed.add_field(name="Backup di partenza", value=parent_path.name, inline=False)
     embed.add_field(name="File metadati", value=str(meta_path.name), inline=False)
     embed.set_footer(text="Usa !restorebackup <nomefile> per ripristinare da questo backup")
     await progress_msg.edit(content=None, embed=embed)
 
 
+JOB_STATUS_LABELS = {
+    "queued": "🕒 In coda",
+    "running": "⏳ In corso",
+    "done": "✅ Completato",
+    "failed": "❌ Fallito",
+    "cancelled": "🚫 Annullato",
+}
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def backupstatus(ctx):
+    jobs = job_queue.guild_jobs(ctx.guild.id)
+    if not jobs:
+        await ctx.send("ℹ️ Nessun backup in coda o eseguito per questo server.")
+        return
+    embed = discord.Embed(title="📋 Stato dei backup", color=discord.Color.blue())
+    live_stats = BACKUP_STATS.get(ctx.guild.id)
+    for job in jobs:
+        lines = [f"Metodo: {job['methods'].upper()} • Modalità: {job['mode'].upper()} • Priorità: {job['priority']}"]
+        if job["status"] == "queued":
+            lines.append(f"Posizione in coda: {job_queue.position(job['id'])}")
+        elif job["status"] == "running" and live_stats is not None and live_stats.finished is None:
+            lines.append(live_stats.summary())
+        if job["backup_dir"]:
+            lines.append(f"Cartella: {Path(job['backup_dir']).name}")
+        if job["error"]:
+            lines.append(f"Errore: {job['error'][:200]}")
+        requested_by = "pianificazione" if job["schedule_id"] else job["requested_by"]
+        embed.add_field(
+            name=f"#{job['id']} {JOB_STATUS_LABELS.get(job['status'], job['status'])} • {requested_by}",
+            value="\n".join(lines)[:1024],
+            inline=False,
+        )
+    schedules = job_queue.schedules(ctx.guild.id)
+    if schedules:
+        embed.set_footer(text=f"{len(schedules)} backup pianificati • !backupschedule list")
+    await ctx.send(embed=embed)
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def backupcancel(ctx, job_id: int):
+    status = job_queue.cancel(job_id, ctx.guild.id)
+    if status is None:
+        await ctx.send(f"❌ Backup #{job_id} non trovato per questo server.")
+    elif status == "queued":
+        await ctx.send(f"🚫 Backup #{job_id} rimosso dalla coda.")
+    elif status == "running":
+        await ctx.send(f"🚫 Annullamento del backup #{job_id}. Potrai riprenderlo con `!backup resume <cartella>`.")
+    else:
+        await ctx.send(f"ℹ️ Il backup #{job_id} è già terminato.")
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def backupschedule(ctx, azione: str = None, *args):
+    azione = (azione or "").lower()
+    if azione == "add" and args:
+        try:
+            cron = CronSchedule(args[0])
+        except ValueError as e:
+            await ctx.send(f"❌ {e}")
+            return
+        methods, mode = default_backup_options(args[1] if len(args) > 1 else None, args[2] if len(args) > 2 else None)
+        options = [arg.lower() for arg in args[3:]]
+        incremental = any(option in ("incrementale", "incremental") for option in options)
+        members = any(option in ("membri", "members") for option in options)
+        priority = next((int(option) for option in options if option.lstrip("-").isdigit()), 5)
+        schedule_id = job_queue.add_schedule(
+            ctx.guild.id, ctx.channel.id, cron.expression, methods, mode, incremental, priority, str(ctx.author), members
+        )
+        await ctx.send(
+            f"🗓️ Backup pianificato #{schedule_id}: `{cron.expression}` • "
+            f"{', '.join(methods).upper()} • {mode.upper()}{' • incrementale' if incremental else ''}"
+            f"{' • membri' if members else ''}"
+        )
+    elif azione == "list":
+        schedules = job_queue.schedules(ctx.guild.id)
+        if not schedules:
+            await ctx.send("ℹ️ Nessun backup pianificato per questo server.")
+            return
+        lines = [
+            f"#{row['id']} `{row['cron']}` • {row['methods'].upper()} • {row['mode'].upper()}"
+            f"{' • incrementale' if row['incremental'] else ''}{' • membri' if row['members'] else ''}"
+            f" • priorità {row['priority']}"
+            f" • ultimo avvio: {row['last_run'] or 'mai'}"
+            for row in schedules
+        ]
+        await ctx.send("🗓️ Backup pianificati:\n" + "\n".join(lines))
+    elif azione == "remove" and args and args[0].isdigit():
+        if job_queue.remove_schedule(int(args[0]), ctx.guild.id):
+            await ctx.send(f"🗑️ Pianificazione #{args[0]} rimossa.")
+        else:
+            await ctx.send(f"❌ Pianificazione #{args[0]} non trovata.")
+    else:
+        await ctx.send(
+            "❌ Uso: `!backupschedule add \"<cron>\" [metodo] [modalità] [incrementale] [membri] [priorità]`, "
+            "`!backupschedule list` oppure `!backupschedule remove <id>`"
+        )
+
+
 @bot.command()
 @commands.has_permissions(administrator=True)
-async def restorebackup(ctx, nomefile: str):
+async def restorebackup(ctx, nomefile: str, *opzioni: str):
     guild = ctx.guild
     if not ctx.author.guild_permissions.administrator:
         await ctx.send("❌ Devi essere amministratore per usare questo comando.")
@@ -447,8 +2952,11 @@ async def restorebackup(ctx, nomefile: str):
     if str(meta.get("guild_id")) != str(guild.id):
         await ctx.send("❌ Questo backup appartiene a un altro server.")
         return
-    method = meta.get("method", "json").lower()
-    data_file_name = meta.get("data_file")
+    try:
+        chain = load_backup_chain(base, meta)
+    except Exception:
+        await ctx.send("❌ Catena di backup incrementali incompleta: un backup precedente non è leggibile.")
+        return
     structure_file_name = meta.get("structure_file")
     if not structure_file_name:
         await ctx.send("❌ File di struttura mancante nei metadati, impossibile procedere.")
@@ -464,10 +2972,46 @@ async def restorebackup(ctx, nomefile: str):
     except Exception:
         await ctx.send("❌ Impossibile leggere la struttura del backup.")
         return
+    options = {opzione.lower() for opzione in opzioni}
+    compact = bool(options & {"compatto", "compact"})
+    targeted = bool(options & {"mirato", "targeted"})
+    live_messages = bool(options & {"messaggi", "messages"})
+    if options - {"compatto", "compact", "mirato", "targeted", "messaggi", "messages"} or (live_messages and not targeted):
+        await ctx.send(
+            "❌ Opzione non valida. Usa `compatto` per unire i messaggi consecutivi, `mirato` per ripristinare solo "
+            "ciò che manca o è cambiato e `mirato messaggi` per reinviare anche i messaggi eliminati dai canali esistenti."
+        )
+        return
+    verify_msg = await ctx.send("🔐 Verifica dell'integrità del backup...")
+    results = await verify_backup_chain(chain, verify_msg)
+    problems = verification_problems(results)
+    if problems:
+        await verify_msg.edit(
+            content="❌ Il backup non ha superato la verifica d'integrità, ripristino annullato:\n" + "\n".join(problems)
+        )
+        return
+    if any(result is None for _, result in results):
+        await verify_msg.edit(content="⚠️ Backup senza manifest d'integrità: verifica saltata.")
+    else:
+        await verify_msg.edit(content="🔐 Backup verificato.")
+    diff = None
+    scope = "Tutti i canali e molti elementi del server verranno eliminati e ricreati.\n"
+    if targeted:
+        diff = StructureDiff(structure, guild_structure(guild))
+        if diff.is_empty() and not live_messages:
+            await ctx.send("✅ Ruoli, categorie e canali corrispondono già al backup: niente da ripristinare.")
+            return
+        scope = (
+            "Verranno creati o aggiornati solo gli elementi mancanti o modificati, senza eliminare nulla:\n"
+            + "\n".join(diff.summary())
+            + "\n"
+        )
+        if live_messages:
+            scope += "I messaggi eliminati dai canali esistenti verranno reinviati in fondo al canale.\n"
     warning = (
         f"⚠️ Stai per ripristinare il backup di **{meta.get('guild_name','sconosciuto')}** "
         f"creato il {meta.get('created_at','sconosciuto')}.\n"
-        "Tutti i canali e molti elementi del server verranno eliminati e ricreati.\n"
+        f"{scope}"
         "Gli autori originali e i timestamp dei messaggi non possono essere ripristinati.\n\n"
         "Scrivi `CONFERMO` entro 60 secondi per continuare."
     )
@@ -484,133 +3028,774 @@ async def restorebackup(ctx, nomefile: str):
     if reply.content.strip().upper() != "CONFERMO":
         await ctx.send("❌ Ripristino annullato.")
         return
-    progress_msg = await ctx.send("🧹 Pulizia server in corso...")
-    for channel in list(guild.channels):
-        try:
-            await channel.delete(reason="Restore backup")
-        except Exception:
-            continue
-    for role in sorted(guild.roles, key=lambda r: r.position, reverse=True):
-        if role.is_default():
-            continue
+    try:
+        channel_messages = await load_channel_messages(chain)
+    except Exception as e:
+        await ctx.send(f"❌ Lettura dei messaggi fallita ({e}), ripristino annullato.")
+        return
+    progress_msg = await ctx.send("♻️ Ripristino mirato in corso..." if targeted else "🧹 Pulizia server in corso...")
+    mentions = load_mention_table(chain)
+    progress = await restore_guild(guild, structure, channel_messages, progress_msg, compact, mentions, diff, live_messages)
+    await safe_edit(progress_msg, content=f"✅ Ripristino completato.\n{progress.render()}")
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def searchbackup(ctx, nomefile: str = None, *, query: str = None):
+    if not nomefile or not query:
+        await ctx.send("❌ Uso: `!searchbackup <file_metadati> <testo da cercare>`")
+        return
+    meta_path = find_metadata_path(nomefile)
+    if not meta_path.is_file():
+        await ctx.send(f"❌ File di backup non trovato: {meta_path.name}")
+        return
+    try:
+        meta = read_json_file(meta_path)
+        chain = load_backup_chain(meta_path, meta)
+    except Exception:
+        await ctx.send("❌ Impossibile leggere il backup o la sua catena incrementale.")
+        return
+    if str(meta.get("guild_id")) != str(ctx.guild.id):
+        await ctx.send("❌ Questo backup appartiene a un altro server.")
+        return
+    match = fts_query(query)
+    if not match:
+        await ctx.send("❌ Specifica almeno una parola da cercare.")
+        return
+    status_msg = await ctx.send("🔎 Ricerca in corso...")
+    hits = {}
+    elapsed = 0.0
+    try:
+        for link_dir, link_meta in chain:
+            index_path = find_search_index(link_dir, link_meta)
+            if index_path is None:
+                await status_msg.edit(content=f"🗂️ Creazione dell'indice di ricerca per {link_dir.name}...")
+                index_path = await asyncio.to_thread(find_search_index, link_dir, link_meta, True)
+            if index_path is None:
+                continue
+            start = time.perf_counter()
+            for row in await asyncio.to_thread(search_index, index_path, match):
+                hits[row[0]] = row
+            elapsed += time.perf_counter() - start
+    except sqlite3.OperationalError as e:
+        await status_msg.edit(content=f"❌ Ricerca non disponibile: {e}")
+        return
+    results = sorted(hits.values(), key=lambda row: row[6])[:SEARCH_RESULTS]
+    if not results:
+        await status_msg.edit(content=f"🔎 Nessun risultato per **{query[:200]}** ({elapsed * 1000:.0f} ms).")
+        return
+    mentions = load_mention_table(chain)
+    embed = discord.Embed(title=f"🔎 Risultati per: {query[:200]}", color=discord.Color.blue())
+    for message_id, channel_id, channel_name, author_tag, created_at, content, score in results:
+        text = resolve_mentions(content, mentions)
+        if len(text) > 300:
+            text = text[:297] + "..."
+        embed.add_field(
+            name=f"#{channel_name or channel_id} • {author_tag} • {(created_at or '')[:19]}"[:256],
+            value=text or "*(nessun testo)*",
+            inline=False,
+        )
+    embed.set_footer(text=f"{len(results)} risultati • {elapsed * 1000:.0f} ms")
+    await status_msg.edit(content=None, embed=embed)
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def verifybackup(ctx, nomefile: str = None, opzione: str = None):
+    if not nomefile:
+        await ctx.send("❌ Uso: `!verifybackup <file_metadati|cartella> [completo]`")
+        return
+    full = (opzione or "").lower() in ("completo", "full")
+    meta_path = find_metadata_path(nomefile)
+    if not meta_path.is_file():
+        await ctx.send(f"❌ File di backup non trovato: {meta_path.name}")
+        return
+    try:
+        meta = read_json_file(meta_path)
+        chain = load_backup_chain(meta_path, meta)
+    except Exception:
+        await ctx.send("❌ Impossibile leggere il backup o la sua catena incrementale.")
+        return
+    if str(meta.get("guild_id")) != str(ctx.guild.id):
+        await ctx.send("❌ Questo backup appartiene a un altro server.")
+        return
+    status_msg = await ctx.send("🔐 Verifica dell'integrità in corso...")
+    start = time.perf_counter()
+    results = await verify_backup_chain(chain, status_msg, full)
+    elapsed = time.perf_counter() - start
+    problems = verification_problems(results)
+    embed = discord.Embed(
+        title="❌ Verifica fallita" if problems else "✅ Backup integro",
+        color=discord.Color.red() if problems else discord.Color.green(),
+    )
+    for link_dir, result in results:
+        if result is None:
+            value = "⚠️ Nessun manifest: backup creato prima della verifica d'integrità"
+        elif "error" in result:
+            value = f"❌ {result['error']}"
+        else:
+            value = (
+                f"{result['files']} file • {result['bytes'] / (1024 * 1024):.1f} MB • {result['hashed']} ricalcolati\n"
+                f"{len(result['missing'])} mancanti • {len(result['changed'])} modificati"
+            )
+        embed.add_field(name=link_dir.name[:256], value=value, inline=False)
+    if problems:
+        embed.add_field(name="Problemi", value="\n".join(problems)[:1024], inline=False)
+    embed.set_footer(text=f"Verifica completata in {elapsed:.1f}s")
+    await status_msg.edit(content=None, embed=embed)
+
+
+def load_backup_for_diff(nomefile, guild):
+    meta_path = find_metadata_path(nomefile)
+    if not meta_path.is_file():
+        raise ValueError(f"File di backup non trovato: {meta_path.name}")
+    try:
+        meta = read_json_file(meta_path)
+        chain = load_backup_chain(meta_path, meta)
+        structure = read_json_file(meta_path.parent / meta["structure_file"])
+    except Exception:
+        raise ValueError(f"Impossibile leggere il backup {meta_path.parent.name} o la sua catena incrementale.") from None
+    if str(meta.get("guild_id")) != str(guild.id):
+        raise ValueError("Questo backup appartiene a un altro server.")
+    return meta_path, chain, structure
+
+
+def describe_diff_items(items, limit=15):
+    names = [str(item.get("name")) for item in items]
+    if len(names) > limit:
+        names = names[:limit] + [f"... e altri {len(names) - limit}"]
+    return ", ".join(names)[:1024]
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def diffbackup(ctx, nomefile: str = None, altro: str = None, opzione: str = None):
+    if altro and altro.lower() in ("messaggi", "messages"):
+        altro, opzione = None, altro
+    if not nomefile or (opzione and opzione.lower() not in ("messaggi", "messages")):
+        await ctx.send("❌ Uso: `!diffbackup <file_metadati> [altro_file_metadati]` oppure `!diffbackup <file_metadati> messaggi`")
+        return
+    try:
+        meta_path, chain, structure = load_backup_for_diff(nomefile, ctx.guild)
+        other = load_backup_for_diff(altro, ctx.guild) if altro else None
+    except ValueError as e:
+        await ctx.send(f"❌ {e}")
+        return
+    diff = StructureDiff(structure, other[2] if other else guild_structure(ctx.guild))
+    target_label = other[0].parent.name if other else "server attuale"
+    status_msg = await ctx.send("🔍 Confronto in corso...")
+    embed = discord.Embed(
+        title=f"🔍 {meta_path.parent.name} → {target_label}"[:256],
+        description="\n".join(diff.summary()),
+        color=discord.Color.blue(),
+    )
+    labels = {"roles": "Ruoli", "categories": "Categorie", "channels": "Canali"}
+    for section, label in labels.items():
+        source_items = {item["id"]: item for item in diff.source.get(section, [])}
+        if diff.missing[section]:
+            embed.add_field(name=f"{label} mancanti", value=describe_diff_items(diff.missing[section]), inline=False)
+        if diff.changed[section]:
+            changed = [
+                {"name": f"{source_items[item_id].get('name')} ({', '.join(fields)})"}
+                for item_id, fields in diff.changed[section].items()
+            ]
+            embed.add_field(name=f"{label} modificati", value=describe_diff_items(changed), inline=False)
+        if diff.extra[section]:
+            embed.add_field(name=f"{label} in più", value=describe_diff_items(diff.extra[section]), inline=False)
+    if other or opzione:
         try:
-            await role.delete(reason="Restore backup")
-        except Exception:
-            continue
-    await progress_msg.edit(content="📁 Ricostruzione struttura server...")
-    role_map = {}
-    for role_data in sorted(structure.get("roles", []), key=lambda r: r.get("position", 0)):
-        if role_data.get("name") == "@everyone":
-            role_map[role_data["id"]] = guild.default_role
-            continue
+            channel_messages = await load_channel_messages(chain)
+            other_messages = await load_channel_messages(other[1]) if other else None
+        except Exception as e:
+            await status_msg.edit(content=f"❌ Lettura dei messaggi fallita ({e}).")
+            return
+        channel_names = {item["id"]: item.get("name") for item in structure.get("channels", [])}
+        totals = {"missing": 0, "changed": 0, "extra": 0}
+        lines = []
+        skipped = 0
+        for channel_id, sources in channel_messages.items():
+            target_id = diff.mapped_id("channels", channel_id)
+            if other:
+                target = chain_messages(other_messages.get(target_id, []))
+            elif target_id == channel_id and ctx.guild.get_channel(channel_id) is not None:
+                target = live_channel_messages(ctx.guild.get_channel(channel_id))
+            else:
+                skipped += 1
+                continue
+            await safe_edit(status_msg, content=f"🔍 Confronto dei messaggi di #{channel_names.get(channel_id, channel_id)}...")
+            counts = await diff_message_streams(chain_messages(sources), target, stop_with_source=not other)
+            for key, value in counts.items():
+                totals[key] += value
+            if any(counts.values()):
+                lines.append(
+                    f"#{channel_names.get(channel_id, channel_id)}: {counts['missing']} mancanti • "
+                    f"{counts['changed']} modificati • {counts['extra']} in più"
+                )
+        value = f"{totals['missing']} mancanti • {totals['changed']} modificati • {totals['extra']} in più"
+        if skipped:
+            value += f"\n{skipped} canali non confrontabili (eliminati o ricreati)"
+        if lines:
+            value += "\n" + "\n".join(lines[:10])
+        embed.add_field(name="Messaggi", value=value[:1024], inline=False)
+    await status_msg.edit(content=None, embed=embed)
+
+
+async def load_channel_messages(chain):
+    channel_messages = {}
+    for link_dir, link_meta in chain:
         try:
-            new_role = await guild.create_role(
-                name=role_data.get("name") or "role",
-                permissions=discord.Permissions(role_data.get("permissions", 0)),
-                colour=discord.Colour(role_data.get("color", 0)),
-                hoist=role_data.get("hoist", False),
-                mentionable=role_data.get("mentionable", False),
-                reason="Restore backup",
-            )
-            role_map[role_data["id"]] = new_role
-        except Exception:
+            reader = await asyncio.to_thread(open_backup_reader, link_dir, link_meta)
+        except Exception as e:
+            raise ValueError(f"{link_dir.name}: {e}") from e
+        if reader is None:
             continue
-    category_map = {}
-    for cat_data in sorted(structure.get("categories", []), key=lambda c: c.get("position", 0)):
+        for ch, count in reader.channels():
+            channel_messages.setdefault(ch.get("id"), []).append((link_dir, reader.messages(ch), count))
+    return channel_messages
+
+
+async def safe_edit(message, **kwargs):
+    try:
+        await message.edit(**kwargs)
+    except Exception:
+        pass
+
+
+class StructureDiff:
+    fields = {
+        "roles": ("name", "permissions", "color", "hoist", "mentionable"),
+        "categories": ("name",),
+        "channels": ("name", "topic", "nsfw", "slowmode_delay"),
+    }
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.matches = {}
+        self.missing = {}
+        self.changed = {}
+        self.extra = {}
+        self.unrestorable = set()
+        for section in self.fields:
+            self.compare(section)
+
+    @staticmethod
+    def items(structure, section):
+        return sorted(structure.get(section, []), key=lambda item: item.get("position", 0))
+
+    def compare(self, section):
+        targets = self.items(self.target, section)
+        by_id = {item["id"]: item for item in targets}
+        by_name = {}
+        for item in targets:
+            by_name.setdefault((item.get("name") or "").lower(), []).append(item)
+        used = set()
+        matches = {}
+        missing = []
+        changed = {}
+        sources = self.items(self.source, section)
+        for item in sources:
+            target = by_id.get(item["id"])
+            if target is not None:
+                matches[item["id"]] = target
+                used.add(target["id"])
+        for item in sources:
+            if item["id"] in matches:
+                continue
+            target = next((t for t in by_name.get((item.get("name") or "").lower(), []) if t["id"] not in used), None)
+            if target is not None:
+                matches[item["id"]] = target
+                used.add(target["id"])
+            elif item.get("managed"):
+                self.unrestorable.add(item["id"])
+            else:
+                missing.append(item)
+        self.matches[section] = matches
+        for item in sources:
+            target = matches.get(item["id"])
+            if target is None:
+                continue
+            differences = [field for field in self.fields[section] if item.get(field) != target.get(field)]
+            if section != "roles" and self.mapped_overwrites(item) != self.role_overwrites(target, self.target):
+                differences.append("overwrites")
+            if section == "channels" and self.mapped_id("categories", item.get("category_id")) != target.get("category_id"):
+                differences.append("category")
+            if section == "roles" and item.get("name") == "@everyone":
+                differences = [field for field in differences if field == "permissions"]
+            if differences:
+                changed[item["id"]] = differences
+        self.missing[section] = missing
+        self.changed[section] = changed
+        self.extra[section] = [item for item in targets if item["id"] not in used]
+
+    def mapped_id(self, section, source_id):
+        target = self.matches.get(section, {}).get(source_id)
+        return target["id"] if target else None
+
+    @staticmethod
+    def role_overwrites(item, structure):
+        role_ids = {str(role["id"]) for role in structure.get("roles", [])}
+        return {key: value for key, value in (item.get("overwrites") or {}).items() if key in role_ids}
+
+    def mapped_overwrites(self, item):
         overwrites = {}
-        for target_id, ov in cat_data.get("overwrites", {}).items():
-            role = role_map.get(int(target_id))
-            if not role:
+        for key, value in self.role_overwrites(item, self.source).items():
+            target_id = self.mapped_id("roles", int(key))
+            if int(key) in self.unrestorable:
                 continue
-            allow = discord.Permissions(ov.get("allow", 0))
-            deny = discord.Permissions(ov.get("deny", 0))
-            overwrites[role] = discord.PermissionOverwrite.from_pair(allow, deny)
+            if target_id is None:
+                return None
+            overwrites[str(target_id)] = value
+        return overwrites
+
+    def pending(self, section):
+        return len(self.missing[section]) + len(self.changed[section])
+
+    def is_empty(self):
+        return not any(self.pending(section) for section in self.fields)
+
+    def live_object(self, guild, section, source_id):
+        target_id = self.mapped_id(section, source_id)
+        if target_id is None:
+            return None
+        return guild.get_role(target_id) if section == "roles" else guild.get_channel(target_id)
+
+    def same_channel(self, source_id):
+        return self.mapped_id("channels", source_id) == source_id
+
+    def summary(self):
+        labels = {"roles": "Ruoli", "categories": "Categorie", "channels": "Canali"}
+        return [
+            f"{labels[section]}: {len(self.missing[section])} mancanti • {len(self.changed[section])} modificati"
+            f" • {len(self.extra[section])} in più"
+            for section in self.fields
+        ]
+
+
+async def aiter_messages(messages):
+    if hasattr(messages, "__aiter__"):
+        async for msg in messages:
+            yield msg
+        return
+    for msg in messages:
+        yield msg
+
+
+class MessageCursor:
+    def __init__(self, messages):
+        self.iterator = aiter_messages(messages)
+        self.current = None
+        self.exhausted = False
+
+    async def peek(self):
+        if self.current is None and not self.exhausted:
+            try:
+                self.current = await self.iterator.__anext__()
+            except StopAsyncIteration:
+                self.exhausted = True
+        return self.current
+
+    def advance(self):
+        self.current = None
+
+
+async def chain_messages(sources):
+    for _, messages, _ in sources:
+        async for msg in aiter_messages(messages):
+            yield msg
+
+
+async def live_channel_messages(channel):
+    async for message in channel.history(limit=None, oldest_first=True):
+        yield {"id": message.id, "content": message.content}
+
+
+async def missing_messages(messages, target):
+    async for msg in aiter_messages(messages):
+        current = await target.peek()
+        while current is not None and current["id"] < msg["id"]:
+            target.advance()
+            current = await target.peek()
+        if current is not None and current["id"] == msg["id"]:
+            target.advance()
+            continue
+        yield msg
+
+
+async def diff_message_streams(source, target, stop_with_source=False):
+    source = MessageCursor(source)
+    target = MessageCursor(target)
+    counts = {"missing": 0, "changed": 0, "extra": 0}
+    steps = 0
+    while True:
+        left = await source.peek()
+        if left is None and stop_with_source:
+            return counts
+        right = await target.peek()
+        if left is None and right is None:
+            return counts
+        if right is None or (left is not None and left["id"] < right["id"]):
+            counts["missing"] += 1
+            source.advance()
+        elif left is None or right["id"] < left["id"]:
+            counts["extra"] += 1
+            target.advance()
+        else:
+            if left.get("content") != right.get("content"):
+                counts["changed"] += 1
+            source.advance()
+            target.advance()
+        steps += 1
+        if steps % 1000 == 0:
+            await asyncio.sleep(0)
+
+
+class RestoreProgress:
+    labels = {
+        "cleanup": "🧹 Pulizia",
+        "roles": "👥 Ruoli",
+        "categories": "📁 Categorie",
+        "channels": "#️⃣ Canali",
+        "messages": "💬 Messaggi",
+    }
+
+    def __init__(self):
+        self.phases = {name: {"total": 0, "done": 0, "start": None, "end": None} for name in self.labels}
+
+    def add(self, phase, total):
+        self.phases[phase]["total"] += total
+
+    def begin(self, phase):
+        if self.phases[phase]["start"] is None:
+            self.phases[phase]["start"] = time.monotonic()
+
+    def step(self, phase, count=1):
+        self.phases[phase]["done"] += count
+        self.phases[phase]["end"] = time.monotonic()
+
+    def render(self):
+        lines = []
+        for name, label in self.labels.items():
+            phase = self.phases[name]
+            bar = generate_progress_bar(phase["done"], phase["total"])
+            elapsed = ""
+            if phase["start"] is not None:
+                elapsed = f" • {(phase['end'] or time.monotonic()) - phase['start']:.1f}s"
+            lines.append(f"{label}: {bar}{elapsed}")
+        return "\n".join(lines)
+
+
+def restore_overwrites(overwrites_data, role_map):
+    overwrites = {}
+    for target_id, ov in overwrites_data.items():
+        role = role_map.get(int(target_id))
+        if not role:
+            continue
+        allow = discord.Permissions(ov.get("allow", 0))
+        deny = discord.Permissions(ov.get("deny", 0))
+        overwrites[role] = discord.PermissionOverwrite.from_pair(allow, deny)
+    return overwrites
+
+
+def restore_message_parts(link_dir, msg, mentions=None):
+    header = f"[{msg.get('created_at','sconosciuto')}] {msg.get('author_tag','utente sconosciuto')}"
+    embeds = []
+    for e_dict in msg.get("embeds", []):
         try:
-            new_cat = await guild.create_category(
-                name=cat_data.get("name") or "categoria",
-                overwrites=overwrites,
-                reason="Restore backup",
-            )
-            category_map[cat_data["id"]] = new_cat
+            embeds.append(discord.Embed.from_dict(e_dict))
         except Exception:
             continue
-    channel_map = {}
-    for ch_data in sorted(structure.get("channels", []), key=lambda c: c.get("position", 0)):
-        category = None
-        if ch_data.get("category_id") and ch_data["category_id"] in category_map:
-            category = category_map[ch_data["category_id"]]
-        overwrites = {}
-        for target_id, ov in ch_data.get("overwrites", {}).items():
-            role = role_map.get(int(target_id))
-            if not role:
-                continue
-            allow = discord.Permissions(ov.get("allow", 0))
-            deny = discord.Permissions(ov.get("deny", 0))
-            overwrites[role] = discord.PermissionOverwrite.from_pair(allow, deny)
+    files = []
+    for att in msg.get("attachments", []):
+        saved_path = att.get("saved_path")
+        if not saved_path:
+            continue
+        file_path = link_dir / saved_path
+        if not file_path.exists():
+            continue
+        files.append((file_path, att.get("filename") or file_path.name))
+    return header, resolve_mentions(msg.get("content"), mentions), embeds, files
+
+
+def open_restore_files(files):
+    opened = []
+    for file_path, filename in files:
         try:
-            new_channel = await guild.create_text_channel(
-                name=ch_data.get("name") or "canale",
-                category=category,
-                topic=ch_data.get("topic"),
-                nsfw=ch_data.get("nsfw", False),
-                slowmode_delay=ch_data.get("slowmode_delay", 0),
-                overwrites=overwrites,
-                reason="Restore backup",
-            )
-            channel_map[ch_data["id"]] = new_channel
+            opened.append(discord.File(fp=str(file_path), filename=filename))
         except Exception:
             continue
-    await progress_msg.edit(content="💬 Ripristino messaggi dai dati backup...")
-    if method == "json" and data_file_name:
-        data_path = backup_dir / data_file_name
-        if data_path.exists():
+    return opened
+
+
+async def send_restore_message(target_channel, content, embeds, files):
+    try:
+        await target_channel.send(
+            content=content or None,
+            embeds=embeds or None,
+            files=open_restore_files(files) or None,
+            allowed_mentions=discord.AllowedMentions.none(),
+        )
+    except Exception:
+        return False
+    return True
+
+
+class MessageCoalescer:
+    def __init__(self, target_channel, max_file_bytes=None, mentions=None):
+        self.target_channel = target_channel
+        self.max_file_bytes = max_file_bytes
+        self.mentions = mentions
+        self.reset()
+
+    def reset(self):
+        self.lines = []
+        self.length = 0
+        self.embeds = []
+        self.embed_chars = 0
+        self.files = []
+        self.file_bytes = 0
+        self.author = None
+        self.messages = []
+
+    def fits(self, text, embeds, files, file_bytes):
+        separator = 1 if self.lines and text else 0
+        if self.length + separator + len(text) > DISCORD_MESSAGE_LIMIT:
+            return False
+        if len(self.embeds) + len(embeds) > DISCORD_MAX_EMBEDS:
+            return False
+        if self.embeds and self.embed_chars + sum(len(embed) for embed in embeds) > DISCORD_MAX_EMBED_CHARS:
+            return False
+        if len(self.files) + len(files) > DISCORD_MAX_FILES:
+            return False
+        if self.files and self.max_file_bytes and self.file_bytes + file_bytes > self.max_file_bytes:
+            return False
+        return True
+
+    def block(self, header, content, author):
+        if author == self.author:
+            return content
+        return f"{header}\n{content}" if content else header
+
+    async def add(self, link_dir, msg):
+        header, content, embeds, files = restore_message_parts(link_dir, msg, self.mentions)
+        author = msg.get("author_id") or msg.get("author_tag")
+        file_bytes = sum(file_path.stat().st_size for file_path, _ in files)
+        text = self.block(header, content, author)
+        single = f"{header}\n{content}" if content else header
+        if not self.fits(text, embeds, files, file_bytes):
+            await self.flush()
+            text = self.block(header, content, author)
+            while len(text) > DISCORD_MESSAGE_LIMIT:
+                await send_restore_message(self.target_channel, text[:DISCORD_MESSAGE_LIMIT], [], [])
+                text = text[DISCORD_MESSAGE_LIMIT:]
+            single = text
+        if text:
+            self.length += len(text) + (1 if self.lines else 0)
+            self.lines.append(text)
+        self.embeds.extend(embeds)
+        self.embed_chars += sum(len(embed) for embed in embeds)
+        self.messages.append((single, embeds, files))
+        self.files.extend(files)
+        self.file_bytes += file_bytes
+        self.author = author
+
+    async def flush(self):
+        if self.lines or self.embeds or self.files:
+            sent = await send_restore_message(self.target_channel, "\n".join(self.lines), self.embeds, self.files)
+            if not sent and len(self.messages) > 1:
+                for content, embeds, files in self.messages:
+                    while len(content) > DISCORD_MESSAGE_LIMIT:
+                        await send_restore_message(self.target_channel, content[:DISCORD_MESSAGE_LIMIT], [], [])
+                        content = content[DISCORD_MESSAGE_LIMIT:]
+                    await send_restore_message(self.target_channel, content, embeds, files)
+        self.reset()
+
+
+async def restore_channel_messages(target_channel, sources, progress, compact=False, mentions=None):
+    coalescer = MessageCoalescer(target_channel, getattr(target_channel.guild, "filesize_limit", None), mentions) if compact else None
+    for link_dir, messages, _ in sources:
+        async for msg in aiter_messages(messages):
+            if coalescer:
+                await coalescer.add(link_dir, msg)
+            else:
+                header, content, embeds, files = restore_message_parts(link_dir, msg, mentions)
+                content = f"{header}\n{content}" if content else header
+                await send_restore_message(target_channel, content, embeds, files)
+            progress.step("messages")
+            await asyncio.sleep(0)
+    if coalescer:
+        await coalescer.flush()
+
+
+async def edit_channel(channel, **kwargs):
+    await channel.edit(**kwargs)
+    return channel
+
+
+async def restore_guild(guild, structure, channel_messages, progress_msg, compact=False, mentions=None, diff=None, live_messages=False):
+    progress = RestoreProgress()
+    limiter = asyncio.Semaphore(RESTORE_CONCURRENCY)
+    message_limiter = asyncio.Semaphore(RESTORE_CONCURRENCY)
+
+    async def api_call(phase, action):
+        progress.begin(phase)
+        async with limiter:
             try:
-                with open(data_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
+                return await action()
             except Exception:
-                await progress_msg.edit(content="⚠️ Struttura ripristinata, ma lettura messaggi JSON fallita.")
+                return None
+            finally:
+                progress.step(phase)
+
+    async def progress_updater():
+        while True:
+            await safe_edit(progress_msg, content=f"♻️ Ripristino in corso...\n{progress.render()}")
+            await asyncio.sleep(2)
+
+    def pending(section, items):
+        if diff is None:
+            return items
+        return [item for item in items if item["id"] in diff.changed[section] or diff.mapped_id(section, item["id"]) is None]
+
+    updater_task = asyncio.create_task(progress_updater())
+    try:
+        if diff is None:
+            old_channels = list(guild.channels)
+            old_roles = [role for role in guild.roles if not role.is_default() and not role.managed]
+            progress.add("cleanup", len(old_channels) + len(old_roles))
+            await asyncio.gather(
+                *(api_call("cleanup", lambda c=channel: c.delete(reason="Restore backup")) for channel in old_channels),
+                *(api_call("cleanup", lambda r=role: r.delete(reason="Restore backup")) for role in old_roles),
+            )
+
+        roles_data = sorted(structure.get("roles", []), key=lambda r: r.get("position", 0))
+        categories_data = sorted(structure.get("categories", []), key=lambda c: c.get("position", 0))
+        channels_data = sorted(structure.get("channels", []), key=lambda c: c.get("position", 0))
+        role_map = {}
+        if diff is not None:
+            roles_data = [role_data for role_data in roles_data if role_data["id"] not in diff.unrestorable]
+            for role_data in roles_data:
+                role = diff.live_object(guild, "roles", role_data["id"])
+                if role is not None:
+                    role_map[role_data["id"]] = role
+        pending_roles = pending("roles", roles_data)
+        progress.add("roles", len(pending_roles))
+        progress.add("categories", len(pending("categories", categories_data)))
+        progress.add("channels", len(pending("channels", channels_data)))
+        for ch_data in channels_data:
+            if diff is None or diff.mapped_id("channels", ch_data["id"]) is None:
+                progress.add("messages", sum(count for _, _, count in channel_messages.get(ch_data["id"], [])))
+
+        async def restore_role(role_data):
+            options = {
+                "permissions": discord.Permissions(role_data.get("permissions", 0)),
+                "colour": discord.Colour(role_data.get("color", 0)),
+                "hoist": role_data.get("hoist", False),
+                "mentionable": role_data.get("mentionable", False),
+                "reason": "Restore backup",
+            }
+            if role_data.get("name") == "@everyone":
+                role_map[role_data["id"]] = guild.default_role
+                if diff is not None:
+                    await guild.default_role.edit(permissions=options["permissions"], reason="Restore backup")
                 return
-            media_root = backup_dir / "media"
-            for ch in data.get("channels", []):
-                target_channel = channel_map.get(ch.get("id"))
-                if not target_channel:
-                    continue
-                for msg in ch.get("messages", []):
-                    content_lines = []
-                    header = f"[{msg.get('created_at','sconosciuto')}] {msg.get('author_tag','utente sconosciuto')}"
-                    content_lines.append(header)
-                    main_content = msg.get("content") or ""
-                    if main_content:
-                        content_lines.append(main_content)
-                    content = "\n".join(content_lines)
-                    embeds = []
-                    for e_dict in msg.get("embeds", []):
-                        try:
-                            embeds.append(discord.Embed.from_dict(e_dict))
-                        except Exception:
-                            continue
-                    files = []
-                    for att in msg.get("attachments", []):
-                        saved_path = att.get("saved_path")
-                        if not saved_path:
-                            continue
-                        file_path = backup_dir / saved_path
-                        if not file_path.exists():
-                            continue
-                        try:
-                            files.append(discord.File(fp=str(file_path), filename=att.get("filename") or file_path.name))
-                        except Exception:
-                            continue
-                    try:
-                        await target_channel.send(content=content or None, embeds=embeds or None, files=files or None)
-                    except Exception:
-                        continue
-                    await asyncio.sleep(0)
-    await progress_msg.edit(content="✅ Ripristino completato.")
+            existing_role = role_map.get(role_data["id"])
+            if existing_role is not None:
+                await existing_role.edit(name=role_data.get("name") or "role", **options)
+                return
+            new_role = await guild.create_role(name=role_data.get("name") or "role", **options)
+            role_map[role_data["id"]] = new_role
 
+        async def restore_roles():
+            await asyncio.gather(*(api_call("roles", lambda r=role_data: restore_role(r)) for role_data in pending_roles))
+            positions = {
+                role_map[role_data["id"]]: role_data["position"]
+                for role_data in pending_roles
+                if role_data["id"] in role_map and role_data.get("name") != "@everyone"
+            }
+            if positions:
+                try:
+                    await guild.edit_role_positions(positions, reason="Restore backup")
+                except Exception:
+                    pass
 
-load_env_from_file()
-TOKEN = os.getenv("DISCORD_BOT_TOKEN", "").strip()
-if not TOKEN:
-    raise RuntimeError("Imposta la variabile di ambiente DISCORD_BOT_TOKEN con il token del bot.")
-bot.run(TOKEN)
+        async def restore_category(cat_data):
+            await roles_task
+            existing_category = diff.live_object(guild, "categories", cat_data["id"]) if diff else None
+            if existing_category is not None and cat_data["id"] not in diff.changed["categories"]:
+                return existing_category
+            options = {
+                "name": cat_data.get("name") or "categoria",
+                "overwrites": restore_overwrites(cat_data.get("overwrites", {}), role_map),
+                "reason": "Restore backup",
+            }
+            if existing_category is not None:
+                return await api_call("categories", lambda: edit_channel(existing_category, **options))
+            return await api_call(
+                "categories",
+                lambda: guild.create_category(position=cat_data.get("position", 0), **options),
+            )
+
+        async def restore_channel(ch_data):
+            await roles_task
+            existing_channel = diff.live_object(guild, "channels", ch_data["id"]) if diff else None
+            if existing_channel is not None and ch_data["id"] not in diff.changed["channels"]:
+                return existing_channel
+            category = None
+            category_task = category_tasks.get(ch_data.get("category_id"))
+            if category_task:
+                category = await category_task
+            options = {
+                "name": ch_data.get("name") or "canale",
+                "category": category,
+                "topic": ch_data.get("topic"),
+                "nsfw": ch_data.get("nsfw", False),
+                "slowmode_delay": ch_data.get("slowmode_delay", 0),
+                "overwrites": restore_overwrites(ch_data.get("overwrites", {}), role_map),
+                "reason": "Restore backup",
+            }
+            if existing_channel is not None:
+                return await api_call("channels", lambda: edit_channel(existing_channel, **options))
+            return await api_call(
+                "channels",
+                lambda: guild.create_text_channel(position=ch_data.get("position", 0), **options),
+            )
+
+        async def restore_messages(ch_data):
+            target_channel = await channel_tasks[ch_data["id"]]
+            sources = channel_messages.get(ch_data["id"])
+            if not target_channel or not sources:
+                return
+            if diff is not None and diff.mapped_id("channels", ch_data["id"]) is not None:
+                # Only the original channel still holds the original message IDs; a channel matched by name
+                # (e.g. recreated by an earlier restore) cannot be diffed and is left as it is.
+                if not live_messages or not diff.same_channel(ch_data["id"]):
+                    return
+                live = MessageCursor(live_channel_messages(target_channel))
+
+                async def counted(messages):
+                    async for msg in missing_messages(messages, live):
+                        progress.add("messages", 1)
+                        yield msg
+
+                sources = [(link_dir, counted(messages), count) for link_dir, messages, count in sources]
+            async with message_limiter:
+                progress.begin("messages")
+                await restore_channel_messages(target_channel, sources, progress, compact, mentions)
+
+        progress.begin("roles")
+        roles_task = asyncio.create_task(restore_roles())
+        category_tasks = {cat_data["id"]: asyncio.create_task(restore_category(cat_data)) for cat_data in categories_data}
+        channel_tasks = {ch_data["id"]: asyncio.create_task(restore_channel(ch_data)) for ch_data in channels_data}
+        message_tasks = [asyncio.create_task(restore_messages(ch_data)) for ch_data in channels_data]
+        await asyncio.gather(roles_task, *category_tasks.values(), *channel_tasks.values(), *message_tasks)
+    finally:
+        updater_task.cancel()
+    return progress
+
+
+if __name__ == "__main__":
+    TOKEN = os.getenv("DISCORD_BOT_TOKEN", "").strip()
+    if not TOKEN:
+        raise RuntimeError("Imposta la variabile di ambiente DISCORD_BOT_TOKEN con il token del bot.")
+    bot.run(TOKEN)
@@ -0,0 +1,284 @@
+import os
+import asyncio
+import sqlite3
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("discord")
+os.environ.setdefault("DISCORD_BOT_TOKEN", "test")
+import bot
+import bench
+
+
+class FakeContext:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+        return bench.FakeProgressMessage()
+
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, "MEDIA_STORE_DIR", tmp_path / "media_store")
+    monkeypatch.setattr(bot, "BACKUP_CHECKPOINT_INTERVAL", 60)
+    monkeypatch.setattr(bot, "BACKUP_WRITE_BATCH", 20)
+    monkeypatch.setattr(bot, "channel_slots", None)
+    return tmp_path
+
+
+def start_backup(guild, methods, mode="full", incremental=False):
+    parent = bot.find_latest_backup(guild.id, methods) if incremental else None
+    backup_dir = bot.create_backup_dir(guild)
+    journal = bot.CheckpointJournal(backup_dir)
+    journal.start(
+        guild_id=guild.id,
+        methods=methods,
+        mode=mode,
+        parent=str(parent[0].resolve()) if parent else None,
+        after_ids=parent[1]["channels_last_message_id"] if parent else {},
+    )
+    return backup_dir, journal
+
+
+async def run_backup(guild, backup_dir, journal=None):
+    await bot.run_backup(FakeContext(), guild, backup_dir, journal or bot.CheckpointJournal(backup_dir))
+    return bot.find_metadata_path(str(backup_dir))
+
+
+async def cancel_after_pages(guild, backup_dir, journal, pages):
+    task = asyncio.create_task(run_backup(guild, backup_dir, journal))
+    while not task.done() and sum(channel.history_calls for channel in guild.text_channels) < pages:
+        await asyncio.sleep(0)
+    assert not task.done()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert asyncio.all_tasks() == {asyncio.current_task()}
+
+
+def backed_up_ids(meta_path):
+    meta = bot.read_json_file(meta_path)
+    ids = {}
+    for link_dir, link_meta in bot.load_backup_chain(meta_path, meta):
+        reader = bot.open_backup_reader(link_dir, link_meta)
+        for ch, _ in reader.channels():
+            ids.setdefault(ch["id"], []).extend(msg["id"] for msg in reader.messages(ch))
+    return ids
+
+
+def source_ids(guild):
+    return {channel.id: [msg.id for msg in channel.messages] for channel in guild.text_channels}
+
+
+def add_messages(guild, count):
+    message_id = max(msg.id for channel in guild.text_channels for msg in channel.messages)
+    for channel in guild.text_channels:
+        last = channel.messages[-1]
+        for number in range(count):
+            message_id += 1
+            channel.messages.append(
+                bench.FakeMessage(message_id, channel, last.author, f"nuovo {number}", last.created_at + timedelta(seconds=number + 1), [], [], [])
+            )
+
+
+async def restore_backup(meta_path, monkeypatch):
+    sent = {}
+
+    async def send(channel, content=None, embeds=None, files=None, **kwargs):
+        sent.setdefault(channel.name, []).append(content)
+        for file in files or ():
+            file.close()
+
+    monkeypatch.setattr(bench.FakeTextChannel, "send", send)
+    meta = bot.read_json_file(meta_path)
+    structure = bot.read_json_file(meta_path.parent / meta["structure_file"])
+    channel_messages = await bot.load_channel_messages(bot.load_backup_chain(meta_path, meta))
+    await bot.restore_guild(bench.FakeGuild.empty(meta["guild_id"]), structure, channel_messages, bench.FakeProgressMessage())
+    return sent
+
+
+def assert_restored(sent, guild):
+    assert sorted(sent) == sorted(channel.name for channel in guild.text_channels)
+    for channel in guild.text_channels:
+        assert len(sent[channel.name]) == len(channel.messages)
+        assert all(msg.content.strip() in content for msg, content in zip(channel.messages, sent[channel.name]))
+
+
+@pytest.mark.parametrize("method", ["json", "db", "archive"])
+def test_backup_restore_round_trip(method, monkeypatch):
+    async def scenario():
+        guild = bench.FakeGuild(channels=3, messages=250)
+        backup_dir, journal = start_backup(guild, [method])
+        meta_path = await run_backup(guild, backup_dir, journal)
+        assert backed_up_ids(meta_path) == source_ids(guild)
+        assert_restored(await restore_backup(meta_path, monkeypatch), guild)
+
+    asyncio.run(scenario())
+
+
+def test_txt_backup_round_trip():
+    async def scenario():
+        guild = bench.FakeGuild(channels=3, messages=250, embed_density=0)
+        backup_dir, journal = start_backup(guild, ["txt"])
+        await run_backup(guild, backup_dir, journal)
+        for channel in guild.text_channels:
+            lines = (backup_dir / "logs" / f"{channel.name}.txt").read_text(encoding="utf-8").splitlines()
+            assert [line.split("): ", 1)[1] for line in lines] == [msg.content for msg in channel.messages]
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("method", ["json", "db", "archive"])
+def test_incremental_chain_restore(method, monkeypatch):
+    async def scenario():
+        guild = bench.FakeGuild(channels=3, messages=250)
+        backup_dir, journal = start_backup(guild, [method])
+        await run_backup(guild, backup_dir, journal)
+        add_messages(guild, 120)
+        backup_dir, journal = start_backup(guild, [method], incremental=True)
+        meta_path = await run_backup(guild, backup_dir, journal)
+        assert len(bot.load_backup_chain(meta_path, bot.read_json_file(meta_path))) == 2
+        assert backed_up_ids(meta_path) == source_ids(guild)
+        assert_restored(await restore_backup(meta_path, monkeypatch), guild)
+
+    asyncio.run(scenario())
+
+
+def test_channel_pool_waits_for_cancelled_workers():
+    async def scenario():
+        cleaned = []
+
+        async def worker(channel):
+            if channel == 1:
+                await asyncio.sleep(0.01)
+                raise RuntimeError("canale fallito")
+            try:
+                await asyncio.sleep(10)
+            finally:
+                await asyncio.sleep(0.01)
+                cleaned.append(channel)
+
+        with pytest.raises(RuntimeError):
+            await bot.run_channel_pool([1, 2, 3], worker, bench.FakeProgressMessage(), "TEST", concurrency=3)
+        assert sorted(cleaned) == [2, 3]
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("method", ["json", "db"])
+@pytest.mark.parametrize("pages", [2, 5, 10])
+def test_resume_after_cancel(method, pages):
+    async def scenario():
+        guild = bench.FakeGuild(channels=3, messages=400)
+        backup_dir, journal = start_backup(guild, [method])
+        await cancel_after_pages(guild, backup_dir, journal, pages)
+        meta_path = await run_backup(guild, backup_dir)
+        assert bot.CheckpointJournal(backup_dir).complete
+        assert backed_up_ids(meta_path) == source_ids(guild)
+
+    asyncio.run(scenario())
+
+
+def test_archive_resume_twice(monkeypatch):
+    monkeypatch.setattr(bot, "BACKUP_ARCHIVE_BLOCK_SIZE", 4096)
+
+    async def scenario():
+        guild = bench.FakeGuild(channels=3, messages=400)
+        backup_dir, journal = start_backup(guild, ["archive"])
+        await cancel_after_pages(guild, backup_dir, journal, 4)
+        await cancel_after_pages(guild, backup_dir, bot.CheckpointJournal(backup_dir), 10)
+        meta_path = await run_backup(guild, backup_dir)
+        assert backed_up_ids(meta_path) == source_ids(guild)
+
+    asyncio.run(scenario())
+
+
+async def wait_for_job(queue, job_id, status):
+    for _ in range(2000):
+        if queue.get(job_id)["status"] == status:
+            return
+        await asyncio.sleep(0.005)
+    raise AssertionError(f"job {job_id}: {queue.get(job_id)['status']} invece di {status}")
+
+
+def test_job_queue_stop_requeues_running_job(work_dir, monkeypatch):
+    async def scenario():
+        guild = bench.FakeGuild(channels=3, messages=400)
+        destination = FakeContext()
+        monkeypatch.setattr(bot.bot, "get_guild", lambda guild_id: guild)
+        monkeypatch.setattr(bot.bot, "get_channel", lambda channel_id: destination)
+        queue = bot.BackupJobQueue(str(work_dir / "jobs.db"))
+        job_id = queue.enqueue(guild.id, 1, ["json"], "full")
+        while sum(channel.history_calls for channel in guild.text_channels) < 3:
+            await asyncio.sleep(0)
+        tasks = list(queue.tasks)
+        await queue.stop()
+        assert all(task.done() for task in tasks)
+        assert queue.conn is None
+        queue.start()
+        await wait_for_job(queue, job_id, "done")
+        assert backed_up_ids(bot.find_metadata_path(queue.get(job_id)["backup_dir"])) == source_ids(guild)
+        await queue.stop()
+
+    asyncio.run(scenario())
+
+
+def test_job_queue_logs_failed_loop(work_dir, monkeypatch, caplog):
+    async def scenario():
+        queue = bot.BackupJobQueue(str(work_dir / "jobs.db"))
+
+        def broken_queue():
+            raise sqlite3.OperationalError("disk I/O error")
+
+        monkeypatch.setattr(queue, "queued", broken_queue)
+        queue.start()
+        await asyncio.gather(queue.tasks[0], return_exceptions=True)
+        await asyncio.sleep(0)
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert "Ciclo della coda dei backup terminato: BackupJobQueue.dispatch_loop" in caplog.text
+
+
+class FlakyChannel(bench.FakeTextChannel):
+    def __init__(self, failures):
+        super().__init__(None, 1, "flaky", 0)
+        self.failures = failures
+        self.contents = []
+
+    async def send(self, content=None, **kwargs):
+        if self.failures or len(content or "") > bot.DISCORD_MESSAGE_LIMIT:
+            self.failures = max(0, self.failures - 1)
+            raise RuntimeError("400 Bad Request")
+        self.contents.append(content)
+
+
+def test_coalescer_fallback_respects_message_limit():
+    async def scenario():
+        channel = FlakyChannel(failures=1)
+        coalescer = bot.MessageCoalescer(channel)
+        author = {"author_id": 7, "author_tag": "user7"}
+        await coalescer.add(Path("."), {"id": 1, "created_at": "2021-01-01T00:00:00", "content": "", **author})
+        await coalescer.add(Path("."), {"id": 2, "created_at": "2021-01-01T00:00:01.500000", "content": "x" * 1972, **author})
+        await coalescer.flush()
+        assert all(len(content) <= bot.DISCORD_MESSAGE_LIMIT for content in channel.contents)
+        assert "".join(channel.contents).count("x") == 1972
+
+    asyncio.run(scenario())
+
+
+def test_coalescer_splits_long_messages():
+    async def scenario():
+        channel = FlakyChannel(failures=0)
+        coalescer = bot.MessageCoalescer(channel)
+        await coalescer.add(Path("."), {"id": 1, "author_id": 7, "author_tag": "user7", "content": "x" * 4500})
+        await coalescer.flush()
+        assert all(len(content) <= bot.DISCORD_MESSAGE_LIMIT for content in channel.contents)
+        assert "".join(channel.contents).count("x") == 4500
+
+    asyncio.run(scenario())